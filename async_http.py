@@ -0,0 +1,71 @@
+'''Small aiohttp wrapper used by the async versions of the github/bitbucket fetchers.
+
+aiohttp is only needed when the API runs in async mode, so it is imported
+lazily by new_session and get rather than at module import.
+'''
+import asyncio
+
+# GitHub's secondary rate limits trip on bursts of concurrent requests, so a
+# session keeps at most this many connections per host and a single profile
+# fetch keeps at most MAX_REPO_REQUESTS per repo requests in flight
+MAX_CONNECTIONS_PER_HOST = 10
+MAX_REPO_REQUESTS = 10
+
+
+class RequestError(Exception):
+    '''Raised by get when no response was received, e.g. a connection error or timeout.'''
+
+
+class AsyncResponse:
+    '''A fully read response exposing the parts of requests.Response the fetchers use.'''
+
+    def __init__(self, status_code, links, body, headers=None):
+        self.status_code = status_code
+        self.links = links
+        self.headers = headers or {}
+        self._body = body
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self._body
+
+
+def new_session():
+    '''Create an aiohttp session. The caller is responsible for closing it.'''
+    import aiohttp
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST))
+
+
+async def get(session, url, headers, timeout=None):
+    '''GET url and return an AsyncResponse with the body already decoded.
+
+    timeout is a (connect, read) tuple in seconds like requests takes.
+    '''
+    import aiohttp
+    options = {}
+    if timeout:
+        options['timeout'] = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    try:
+        async with session.get(url, headers=headers, **options) as resp:
+            body = await resp.json(content_type=None) if resp.status < 400 else None
+            links = {rel: {'url': str(link['url'])} for rel, link in resp.links.items()}
+            return AsyncResponse(resp.status, links, body, dict(resp.headers))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise RequestError(f'{type(e).__name__}: {e}') from e
+
+
+async def gather_bounded(fetch, items, limit=None):
+    '''Await fetch(item) for every item with at most limit running at once.
+
+    Returns the results in the order of items, like asyncio.gather.
+    '''
+    semaphore = asyncio.Semaphore(limit or MAX_REPO_REQUESTS)
+
+    async def run(item):
+        async with semaphore:
+            return await fetch(item)
+
+    return await asyncio.gather(*(run(item) for item in items))
@@ -0,0 +1,95 @@
+'''Async version of the API in main.py.
+
+The routes and responses are the same as main.py, but the handlers are
+coroutines and attaching/refreshing a profile awaits the async github and
+bitbucket fetchers, so a single process can keep many crawls in flight.
+Run it with `HDUB_SERVER_MODE=async python main.py`, or under an ASGI
+server such as `hypercorn async_main:app`. Requires quart and aiohttp.
+'''
+import async_http
+import db
+import main
+from quart import Quart, Response, request
+
+app = Quart(__name__)
+
+# aiohttp session shared by all upstream fetches, opened while serving
+SESSION = None
+
+
+@app.before_serving
+async def open_session():
+    global SESSION
+    SESSION = async_http.new_session()
+
+
+@app.after_serving
+async def close_session():
+    await SESSION.close()
+
+
+def json_response(body, status_code):
+    return main.json_response(body, status_code, response_class=Response)
+
+
+@app.route('/user/<username>', methods=['GET', 'POST', 'DELETE'])
+async def user(username):
+    if request.method == 'POST':
+        resp_body, status_code = db.user.create(username)
+    elif request.method == 'GET':
+        return main.get_user_response(username, request, Response)
+    elif request.method == 'DELETE':
+        resp_body, status_code = db.user.delete(username)
+        main.USER_RESPONSE_CACHE.pop(username, None)
+    return json_response(resp_body, status_code)
+
+
+@app.route("/user/<username>/bitbucket/<profile>", methods=['POST', 'PUT', 'DELETE'])
+async def bitbucket_profile(username, profile):
+    if request.method == 'POST':
+        budget = request.args.get('budget', type=float)
+        response, status_code = await db.bitbucket.add_async(username, profile, SESSION, budget)
+    elif request.method == 'PUT':
+        response, status_code = await db.bitbucket.refresh_async(username, profile, SESSION)
+    elif request.method == 'DELETE':
+        response, status_code = db.bitbucket.delete(username, profile)
+    return json_response(response, status_code)
+
+
+@app.route("/user/<username>/github/<profile>", methods=['POST', 'PUT', 'DELETE'])
+async def github_profile(username, profile):
+    if request.method == 'POST':
+        budget = request.args.get('budget', type=float)
+        response, status_code = await db.github.add_async(username, profile, SESSION, budget)
+    elif request.method == 'PUT':
+        response, status_code = await db.github.refresh_async(username, profile, SESSION)
+    elif request.method == 'DELETE':
+        response, status_code = db.github.delete(username, profile)
+    return json_response(response, status_code)
+
+
+@app.route('/leaderboard', methods=['GET'])
+async def leaderboard():
+    metric = request.args.get('metric', 'stars_received')
+    limit = request.args.get('limit', 10, type=int)
+    username = request.args.get('username')
+    response, status_code = db.leaderboard.get(metric, limit, username)
+    return json_response(response, status_code)
+
+
+@app.route('/search', methods=['GET'])
+async def search():
+    response, status_code = db.search.get(
+        languages=request.args.getlist('language'),
+        topics=request.args.getlist('topic'),
+        mode=request.args.get('mode', 'and'),
+        limit=request.args.get('limit', 20, type=int),
+        offset=request.args.get('offset', 0, type=int),
+    )
+    return json_response(response, status_code)
+
+
+@app.route('/webhooks/<any(github, bitbucket):provider>', methods=['POST'])
+async def webhook(provider):
+    response, status_code = main.handle_webhook(provider, request.headers, await request.get_data())
+    return json_response(response, status_code)
@@ -0,0 +1,61 @@
+'''Compare serialization throughput for large merged profiles.
+
+Run with `python bench_serializer.py`. Install orjson to compare the fast
+encoder against the stdlib fallback.
+'''
+import timeit
+
+import db
+import serializer
+from flask import Flask, jsonify
+
+PROFILE_COUNT = 4
+LANGUAGES_PER_PROFILE = 200
+TOPICS_PER_PROFILE = 2000
+ITERATIONS = 200
+
+
+def make_profile(offset):
+    languages = {f'language{offset + i}' for i in range(LANGUAGES_PER_PROFILE)}
+    topics = {f'topic{offset + i}' for i in range(TOPICS_PER_PROFILE)}
+    profile = {field: offset + 1000 for field in db.COUNT_FIELDS}
+    profile.update({
+        'languages': languages,
+        'language_count': len(languages),
+        'repo_topics': topics,
+        'repo_topics_count': len(topics),
+    })
+    return profile
+
+
+def seed():
+    db.user.create('merged')
+    db.user.create('single')
+    for i in range(PROFILE_COUNT):
+        name = f'profile{i}'
+        db.GITHUB_PROFILES[name] = make_profile(i * 100)
+        db.USERS['merged']['github'].add(name)
+    db.BITBUCKET_PROFILES['single'] = make_profile(0)
+    db.USERS['single']['bitbucket'].add('single')
+
+
+def report(label, func):
+    seconds = timeit.timeit(func, number=ITERATIONS)
+    print(f'{label:<40} {ITERATIONS / seconds:>10.1f} responses/s')
+
+
+def main():
+    seed()
+    app = Flask(__name__)
+    encoder = 'orjson' if serializer.orjson is not None else 'json (stdlib)'
+    print(f'encoder: {encoder}')
+
+    with app.app_context():
+        report('merged: jsonify(db.user.get)', lambda: jsonify(db.user.get('merged')[0]).get_data())
+        report('merged: serializer.encode_user', lambda: serializer.encode_user('merged'))
+        report('single: jsonify(db.user.get)', lambda: jsonify(db.user.get('single')[0]).get_data())
+        report('single: serializer.encode_user', lambda: serializer.encode_user('single'))
+
+
+if __name__ == '__main__':
+    main()
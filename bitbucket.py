@@ -1,5 +1,8 @@
-import requests
+import asyncio
+import upstream
+import columnar
 from collections import Counter
+from progress import sum_over_repos, sum_over_repos_async
 
 # https://developer.atlassian.com/bitbucket/api/2/reference/
 BITBUCKET_API_URL = 'https://api.bitbucket.org/2.0'
@@ -8,23 +11,56 @@ BITBUCKET_API_URL = 'https://api.bitbucket.org/2.0'
 DEFAULT_API_HEADERS = {
 }
 
+# newest commit hash and commit total seen for each (profile, repo slug),
+# so refreshing a commit count only pages through newer commits
+COMMIT_CURSORS = {}
+
 
 class BitbucketAPIException(Exception):
     pass
 
 
-def get_profile(profile):
-    '''Takes a user profile and returns a dictionary containing information about their user/team account.'''
+def _get(url, endpoint):
+    '''GET url from the bitbucket API through upstream's retries, circuit breaker and hedging.'''
+    return upstream.get(url, DEFAULT_API_HEADERS, f'bitbucket.{endpoint}', BitbucketAPIException)
+
+
+async def _get_async(session, url, endpoint):
+    '''Async version of _get for the fetchers used in async mode.'''
+    return await upstream.get_async(session, url, DEFAULT_API_HEADERS, f'bitbucket.{endpoint}', BitbucketAPIException)
+
+
+def get_profile(profile, progress=None):
+    '''Takes a user profile and returns a dictionary containing information about their user/team account.
+
+    If a progress.FetchProgress is passed, fields are reported to it as soon as they are known.
+    '''
     repos = get_repos(profile)
     repo_stats = get_repo_stats(repos)
+    if progress:
+        progress.record(
+            public_source_repositories=repo_stats['sources'],
+            public_fork_repositories=repo_stats['forks'],
+            total_account_size=repo_stats['size'],
+            languages=repo_stats['languages'],
+            stars_received=0,
+            stars_given=0,
+            repo_topics=set(),
+        )
 
     # Technically could call these functions during the get_repo_stats
     # function, but they need to make a network call for each repo and
     # the network IO is going to be way more time consuming than looping
     # through repos a few times, also this can make testing slightly more easy.
-    open_issues = get_open_issue_count(profile, repos)
-    commit_count = get_commit_count(profile, repos)
-    watcher_count = get_watcher_count(profile, repos)
+    open_issues = get_open_issue_count(profile, repos, progress=progress)
+    commit_count = get_commit_count(profile, repos, progress=progress)
+    watcher_count = get_watcher_count(profile, repos, progress=progress)
+    if progress:
+        progress.record(
+            total_open_issues=open_issues,
+            total_source_commit_count=commit_count,
+            watcher_count=watcher_count,
+        )
 
     profile_type = get_profile_type(profile)
     if profile_type == 'team':
@@ -34,6 +70,11 @@ def get_profile(profile):
     else:
         raise BitbucketAPIException(f'Unsupported profile type: {profile_type}')
 
+    return _build_profile(repo_stats, open_issues, commit_count, watcher_count, follower_count)
+
+
+def _build_profile(repo_stats, open_issues, commit_count, watcher_count, follower_count):
+    '''Takes the aggregated API results for a profile and returns the profile dictionary.'''
     result = {
         'public_source_repositories': repo_stats['sources'],
         'public_fork_repositories': repo_stats['forks'],
@@ -60,7 +101,7 @@ def get_repos(profile):
     repos = []
 
     while True:
-        resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+        resp = _get(url, 'repos')
         if resp.ok:
             response_json = resp.json()
             repos.extend(response_json['values'])
@@ -77,6 +118,9 @@ def get_repos(profile):
 
 def get_repo_stats(repos):
     '''Take a list of repos return a dictionary of aggregated stats for the repos.'''
+    if columnar.available and len(repos) >= columnar.MIN_REPOS:
+        return columnar.bitbucket_repo_stats(repos)
+
     counts = Counter()
     languages = set()
     for repo in repos:
@@ -95,76 +139,123 @@ def get_repo_stats(repos):
     }
 
 
-def get_open_issue_count(profile, repos):
+def get_open_issue_count(profile, repos, progress=None):
     '''Takes a profile and list of repos and returns the count of open issues'''
-    total_open_issues = 0
-    for repo in repos:
-        if repo['has_issues'] and 'parent' not in repo:
-            total_open_issues += _get_repo_open_issues(profile, repo)
-    return total_open_issues
+    return sum_over_repos(
+        lambda repo: _get_repo_open_issues(profile, repo),
+        [repo for repo in repos if repo['has_issues'] and 'parent' not in repo],
+        'total_open_issues',
+        progress,
+        skip=BitbucketAPIException,
+    )
 
 
 def _get_repo_open_issues(profile, repo):
     '''Takes a profile and repo slug and returns the total count of open issues for that repo'''
     url = f'{BITBUCKET_API_URL}/repositories/{profile}/{repo["slug"]}/issues?q=state="open"'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'issues')
     if resp.ok:
         return resp.json()['size']
     raise BitbucketAPIException(f'Error getting open issue count. Status code: {resp.status_code}')
 
 
-def get_watcher_count(profile, repos):
+def get_watcher_count(profile, repos, progress=None):
     '''Take a profile and list of repos and return the sum of watchers for all repos'''
-    watcher_count = 0
-    for repo in repos:
-        watcher_count += _get_repo_watcher_count(profile, repo)
-    return watcher_count
+    return sum_over_repos(
+        lambda repo: _get_repo_watcher_count(profile, repo),
+        repos,
+        'watcher_count',
+        progress,
+        skip=BitbucketAPIException,
+    )
 
 
 def _get_repo_watcher_count(profile, repo):
     '''Take a profile and repo and return the number of watchers for that repo'''
     url = f'{BITBUCKET_API_URL}/repositories/{profile}/{repo["slug"]}/watchers'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'watchers')
     if resp.ok:
         return resp.json()['size']
     raise BitbucketAPIException(f'Error retrieving watcher count. Status code: {resp.status_code}')
 
 
-def get_commit_count(profile, repos):
-    total_commit_count = 0
-    for repo in repos:
-        if 'parent' not in repo:
-            total_commit_count += _get_repo_commit_count(profile, repo)
-    return total_commit_count
+def get_commit_count(profile, repos, progress=None):
+    '''Sum the commits of the source repos, estimating around repos whose count fails.'''
+    return sum_over_repos(
+        lambda repo: _get_repo_commit_count(profile, repo),
+        [repo for repo in repos if 'parent' not in repo],
+        'total_source_commit_count',
+        progress,
+        skip=BitbucketAPIException,
+    )
+
+
+def get_repo_commit_count(profile, slug):
+    '''Returns the number of commits to one of a profile's repos, resuming from its commit cursor.'''
+    return _get_repo_commit_count(profile, {'slug': slug})
 
 
 def _get_repo_commit_count(profile, repo):
+    '''Takes a profile and repo and returns the number of commits to that repo.
+
+    Commits are listed newest first, so once a repo has been counted only the
+    pages up to the last newest commit seen need walking. If that commit is
+    gone because history was rewritten, the walk runs to the end and the
+    result is a full recount.
+    '''
+    cursor = COMMIT_CURSORS.get((profile, repo['slug']))
     url = f'{BITBUCKET_API_URL}/repositories/{profile}/{repo["slug"]}/commits'
     commit_count = 0
+    newest_hash = None
     while True:
-        resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+        resp = _get(url, 'commits')
         if resp.ok:
             response_json = resp.json()
-            commit_count += len(response_json['values'])
         else:
             raise BitbucketAPIException(f'Error calling repos API. Status code: {resp.status_code}')
+
+        if newest_hash is None and response_json['values']:
+            newest_hash = response_json['values'][0]['hash']
+        new_commits, reached_cursor = _count_commits_before(response_json['values'], cursor)
+        commit_count += new_commits
+        if reached_cursor:
+            commit_count += cursor['count']
+            break
         try:
             # exit loop if we've already exhausted all content
             url = response_json['next']
         except KeyError:
             break
+
+    _save_commit_cursor(profile, repo, newest_hash, commit_count)
     return commit_count
 
 
+def _count_commits_before(commits, cursor):
+    '''Returns how many commits come before the cursor's hash, and whether it was found.'''
+    if cursor is None:
+        return len(commits), False
+    for position, commit in enumerate(commits):
+        if commit['hash'] == cursor['hash']:
+            return position, True
+    return len(commits), False
+
+
+def _save_commit_cursor(profile, repo, newest_hash, commit_count):
+    # an empty repo has nothing to resume from
+    if newest_hash is not None:
+        COMMIT_CURSORS[(profile, repo['slug'])] = {'hash': newest_hash, 'count': commit_count}
+
+
 def get_profile_type(profile):
     '''Takes a profile and returns whether it is a user or team.'''
     url = f'{BITBUCKET_API_URL}/users/{profile}'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'users')
     if resp.ok:
         return 'user'
 
     url = f'{BITBUCKET_API_URL}/teams/{profile}'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'teams')
     if resp.ok:
         return 'team'
 
@@ -185,9 +276,155 @@ def get_user_follower_count(profile):
 def _get_follower_count_by_type(_type, profile):
     '''Takes a profile type [team/user] and profile name and returns follower count.'''
     url = f'{BITBUCKET_API_URL}/{_type}/{profile}/followers'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'followers')
 
     if resp.ok:
         return resp.json()['size']
     else:
         raise BitbucketAPIException(f'Error getting follower count. Status code: {resp.status_code}')
+
+
+# Async versions of the fetchers above, used when the API runs in async mode.
+# Per repo calls are issued concurrently (up to async_http.MAX_REPO_REQUESTS at
+# a time) rather than one repo at a time.
+async def get_profile_async(profile, session, progress=None):
+    '''Takes a user profile and an aiohttp session and returns the same dictionary as get_profile.'''
+    repos = await _get_paginated_values_async(
+        f'{BITBUCKET_API_URL}/repositories/{profile}', session, 'repos', 'Error calling repos API.'
+    )
+    repo_stats = get_repo_stats(repos)
+    if progress:
+        progress.record(
+            public_source_repositories=repo_stats['sources'],
+            public_fork_repositories=repo_stats['forks'],
+            total_account_size=repo_stats['size'],
+            languages=repo_stats['languages'],
+            stars_received=0,
+            stars_given=0,
+            repo_topics=set(),
+        )
+
+    open_issues, commit_count, watcher_count, profile_type = await asyncio.gather(
+        get_open_issue_count_async(profile, repos, session, progress=progress),
+        get_commit_count_async(profile, repos, session, progress=progress),
+        get_watcher_count_async(profile, repos, session, progress=progress),
+        get_profile_type_async(profile, session),
+    )
+
+    if profile_type == 'team':
+        follower_count = await _get_size_async(
+            f'{BITBUCKET_API_URL}/teams/{profile}/followers', session, 'followers', 'Error getting follower count.'
+        )
+    elif profile_type == 'user':
+        follower_count = await _get_size_async(
+            f'{BITBUCKET_API_URL}/users/{profile}/followers', session, 'followers', 'Error getting follower count.'
+        )
+    else:
+        raise BitbucketAPIException(f'Unsupported profile type: {profile_type}')
+
+    return _build_profile(repo_stats, open_issues, commit_count, watcher_count, follower_count)
+
+
+async def _get_paginated_values_async(url, session, endpoint, error_msg):
+    '''Follows the next links from url and returns all of the values.'''
+    values = []
+    while True:
+        resp = await _get_async(session, url, endpoint)
+        if resp.ok:
+            response_json = resp.json()
+            values.extend(response_json['values'])
+        else:
+            raise BitbucketAPIException(f'{error_msg} Status code: {resp.status_code}')
+        try:
+            url = response_json['next']
+        except KeyError:
+            break
+    return values
+
+
+async def _get_size_async(url, session, endpoint, error_msg):
+    '''Returns the size field of the response from url.'''
+    resp = await _get_async(session, url, endpoint)
+    if resp.ok:
+        return resp.json()['size']
+    raise BitbucketAPIException(f'{error_msg} Status code: {resp.status_code}')
+
+
+async def get_open_issue_count_async(profile, repos, session, progress=None):
+    return await sum_over_repos_async(
+        lambda repo: _get_size_async(
+            f'{BITBUCKET_API_URL}/repositories/{profile}/{repo["slug"]}/issues?q=state="open"',
+            session,
+            'issues',
+            'Error getting open issue count.'
+        ),
+        [repo for repo in repos if repo['has_issues'] and 'parent' not in repo],
+        'total_open_issues',
+        progress,
+        skip=BitbucketAPIException,
+    )
+
+
+async def get_watcher_count_async(profile, repos, session, progress=None):
+    return await sum_over_repos_async(
+        lambda repo: _get_size_async(
+            f'{BITBUCKET_API_URL}/repositories/{profile}/{repo["slug"]}/watchers',
+            session,
+            'watchers',
+            'Error retrieving watcher count.'
+        ),
+        repos,
+        'watcher_count',
+        progress,
+        skip=BitbucketAPIException,
+    )
+
+
+async def get_commit_count_async(profile, repos, session, progress=None):
+    return await sum_over_repos_async(
+        lambda repo: _get_repo_commit_count_async(profile, repo, session),
+        [repo for repo in repos if 'parent' not in repo],
+        'total_source_commit_count',
+        progress,
+        skip=BitbucketAPIException,
+    )
+
+
+async def _get_repo_commit_count_async(profile, repo, session):
+    cursor = COMMIT_CURSORS.get((profile, repo['slug']))
+    url = f'{BITBUCKET_API_URL}/repositories/{profile}/{repo["slug"]}/commits'
+    commit_count = 0
+    newest_hash = None
+    while True:
+        resp = await _get_async(session, url, 'commits')
+        if resp.ok:
+            response_json = resp.json()
+        else:
+            raise BitbucketAPIException(f'Error calling repos API. Status code: {resp.status_code}')
+
+        if newest_hash is None and response_json['values']:
+            newest_hash = response_json['values'][0]['hash']
+        new_commits, reached_cursor = _count_commits_before(response_json['values'], cursor)
+        commit_count += new_commits
+        if reached_cursor:
+            commit_count += cursor['count']
+            break
+        try:
+            url = response_json['next']
+        except KeyError:
+            break
+
+    _save_commit_cursor(profile, repo, newest_hash, commit_count)
+    return commit_count
+
+
+async def get_profile_type_async(profile, session):
+    resp = await _get_async(session, f'{BITBUCKET_API_URL}/users/{profile}', 'users')
+    if resp.ok:
+        return 'user'
+
+    resp = await _get_async(session, f'{BITBUCKET_API_URL}/teams/{profile}', 'teams')
+    if resp.ok:
+        return 'team'
+
+    raise BitbucketAPIException('Count not determine profile type.')
@@ -0,0 +1,86 @@
+'''Vectorized versions of github.get_repo_stats and bitbucket.get_repo_stats.
+
+Repos are flattened into one integer matrix in a single pass, with a column
+per summed field and a column of integer language codes, then aggregated
+with numpy reductions. That is much cheaper than summing Counter fields one
+repo at a time for accounts with a very large number of repos. numpy is
+optional: when it isn't installed `available` is False and the pure Python
+versions are used.
+'''
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+available = np is not None
+
+# below this many repos the conversion to arrays costs more than it saves
+MIN_REPOS = 1000
+
+
+def _to_columns(repos, row, width):
+    '''Return (column sums, language codes column, languages by code) for repos.
+
+    row(repo, code) returns the width - 1 integer fields of a repo followed
+    by its language code, where code maps a language to its integer code.
+    '''
+    # language can be None or a blank string, both map to ''
+    codes = {}
+    setdefault = codes.setdefault
+
+    def code(language):
+        return setdefault(language or '', len(codes))
+
+    flat = []
+    extend = flat.extend
+    for repo in repos:
+        extend(row(repo, code))
+    matrix = np.array(flat, dtype=np.int64).reshape(len(repos), width)
+    sums = [int(total) for total in matrix[:, :-1].sum(axis=0)]
+    return sums, matrix[:, -1], list(codes)
+
+
+def _languages(language_codes, names):
+    '''Return the set of lowercased languages used, skipping blank ones.'''
+    return {names[code].lower() for code in np.unique(language_codes).tolist() if names[code]}
+
+
+def _github_row(repo, code):
+    return (
+        repo['fork'], repo['open_issues_count'], repo['stargazers_count'], repo['size'], repo['watchers_count'],
+        code(repo['language']),
+    )
+
+
+def github_repo_stats(repos):
+    '''Same result as github.get_repo_stats.'''
+    sums, language_codes, names = _to_columns(repos, _github_row, 6)
+    forked_repos, open_issues, stars_received, size, watchers = sums
+    return {
+        'forked_repos': forked_repos,
+        'source_repos': len(repos) - forked_repos,
+        'open_issues': open_issues,
+        'stars_received': stars_received,
+        'size': size,
+        'watchers': watchers,
+        'languages': _languages(language_codes, names),
+        'topics': set(chain.from_iterable(repo['topics'] for repo in repos)),
+    }
+
+
+def _bitbucket_row(repo, code):
+    return 'parent' in repo, repo['size'], code(repo['language'])
+
+
+def bitbucket_repo_stats(repos):
+    '''Same result as bitbucket.get_repo_stats.'''
+    sums, language_codes, names = _to_columns(repos, _bitbucket_row, 3)
+    forks, size = sums
+    return {
+        'forks': forks,
+        'size': size,
+        'sources': len(repos) - forks,
+        'languages': _languages(language_codes, names),
+    }
@@ -1,8 +1,343 @@
-from github import get_profile as get_github_profile
-from bitbucket import get_profile as get_bitbucket_profile
+import asyncio
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from itertools import count
+
+from github import get_profile as get_github_profile, get_profile_async as get_github_profile_async
+from bitbucket import get_profile as get_bitbucket_profile, get_profile_async as get_bitbucket_profile_async
+from indexes import InvertedIndex, SortedIndex
+from progress import FetchProgress
+
+# numeric profile fields that are summed when profiles are merged
+COUNT_FIELDS = (
+    'follower_count',
+    'public_fork_repositories',
+    'public_source_repositories',
+    'stars_given',
+    'stars_received',
+    'total_account_size',
+    'total_open_issues',
+    'total_source_commit_count',
+    'watcher_count',
+)
+
+# held while the store is changed, so that e.g. a snapshot sees the users,
+# indexes and profiles in a consistent state. Never held across a fetch.
+STORE_LOCK = threading.RLock()
+
 USERS = {}
 BITBUCKET_PROFILES = {}
 GITHUB_PROFILES = {}
+LEADERBOARDS = {metric: SortedIndex() for metric in COUNT_FIELDS}
+LANGUAGE_INDEX = InvertedIndex()
+TOPIC_INDEX = InvertedIndex()
+# unix timestamp of when each cached profile was last fetched from upstream
+FETCHED_AT = {'bitbucket': {}, 'github': {}}
+# profiles cached with fields that are estimated or missing, keyed by
+# (provider, profile): either their crawl ran out of budget and is finishing
+# in the background, or some of their per repo requests failed. Entries are
+# removed once a crawl completes without either.
+PARTIAL_PROFILES = {}
+
+# sync crawls that haven't finished yet, keyed by (provider, profile), so
+# concurrent attaches of the same profile share one crawl
+_CRAWLS = {}
+
+# async crawls that haven't finished yet, keyed by (provider, profile), as
+# (task, FetchProgress), so concurrent attaches of the same profile share one crawl
+_ASYNC_CRAWLS = {}
+
+# a user's version changes whenever the set of attached profiles (or their
+# contents) changes; versions come from one counter so a deleted and
+# recreated user never reuses one. The counter restarts with the process, so
+# each version also records the epoch of the process that issued it
+USER_VERSIONS = {}
+_version_counter = count(1)
+EPOCH = secrets.token_hex(4)
+
+
+def _profiles(provider):
+    return {'bitbucket': BITBUCKET_PROFILES, 'github': GITHUB_PROFILES}[provider]
+
+
+def cache_profile(provider, name, profile, partial=None, fetched=True):
+    '''Store a fetched profile in the profile cache and record when it was fetched.
+
+    partial is a dict of the fields that are estimated or missing, which is
+    recorded in PARTIAL_PROFILES. A partial profile isn't recorded as
+    fetched, so is_fresh (and prefetch) don't treat it as fresh. With
+    fetched=False the profile was adjusted locally (e.g. by a webhook) rather
+    than crawled, so its fetch time and partial entry are left as they are.
+    '''
+    with STORE_LOCK:
+        _profiles(provider)[name] = profile
+        if not fetched:
+            return
+        if partial:
+            PARTIAL_PROFILES[(provider, name)] = {'fields': partial}
+            FETCHED_AT[provider].pop(name, None)
+        else:
+            PARTIAL_PROFILES.pop((provider, name), None)
+            FETCHED_AT[provider][name] = time.time()
+
+
+def mark_stale(provider, name):
+    '''Forget when a profile was fetched, so is_fresh is False until it is crawled again.'''
+    with STORE_LOCK:
+        FETCHED_AT[provider].pop(name, None)
+
+
+def _fetch(fetch, profile):
+    '''Run a crawl to the end and return (profile, fields estimated around failed repos).'''
+    fetch_progress = FetchProgress()
+    fetched = fetch(profile, progress=fetch_progress)
+    return fetched, fetch_progress.estimated_fields()
+
+
+def fetch_profile(provider, name):
+    '''Crawl a profile without caching it. Returns what update_profile takes after the name.'''
+    return _fetch(get_github_profile if provider == 'github' else get_bitbucket_profile, name)
+
+
+async def _fetch_async(fetch_async, profile, session, fetch_progress=None):
+    fetch_progress = fetch_progress or FetchProgress()
+    fetched = await fetch_async(profile, session, progress=fetch_progress)
+    return fetched, fetch_progress.estimated_fields()
+
+
+def is_fresh(provider, name, max_age):
+    '''Return True if a profile is cached and was fetched less than max_age seconds ago.'''
+    fetched_at = FETCHED_AT[provider].get(name)
+    return name in _profiles(provider) and fetched_at is not None and time.time() - fetched_at < max_age
+
+
+def _fetch_profile(provider, fetch, profile, budget=None):
+    '''Fetch a profile into the profile cache, spending at most budget seconds if given.
+
+    Concurrent fetches of the same profile share one crawl. When the budget
+    runs out a partial profile built from what the crawl has reported so far
+    is cached and recorded in PARTIAL_PROFILES. The crawl keeps going in a
+    background thread and swaps in the full profile with update_profile when
+    it's done.
+    '''
+    key = (provider, profile)
+    with STORE_LOCK:
+        if profile in _profiles(provider):
+            return
+        fetch_progress = _CRAWLS.get(key)
+        started = fetch_progress is None
+        if started:
+            fetch_progress = _CRAWLS[key] = FetchProgress()
+
+    if started and budget is None:
+        _crawl(provider, fetch, profile, fetch_progress)
+    elif started:
+        threading.Thread(
+            target=_crawl, args=(provider, fetch, profile, fetch_progress),
+            name=f'crawl-{provider}-{profile}', daemon=True,
+        ).start()
+
+    if fetch_progress.wait(budget):
+        if fetch_progress.error is not None:
+            raise fetch_progress.error
+        return
+
+    with STORE_LOCK:
+        # the crawl may have finished between the timeout and now
+        if profile not in _profiles(provider):
+            cache_profile(provider, profile, *fetch_progress.partial_profile(COUNT_FIELDS))
+
+
+def _crawl(provider, fetch, profile, fetch_progress):
+    '''Run a crawl for _fetch_profile and store its result, replacing a partial profile if one was cached.'''
+    try:
+        result = fetch(profile, progress=fetch_progress)
+    except Exception as e:
+        with STORE_LOCK:
+            # only set if a partial profile is cached, and a refresh or
+            # prefetch may have completed the profile meanwhile
+            if (provider, profile) in PARTIAL_PROFILES:
+                PARTIAL_PROFILES[(provider, profile)]['error'] = str(e)
+                owner = _find_owner(provider, profile)
+                if owner is not None:
+                    _bump_version(owner)
+            _CRAWLS.pop((provider, profile), None)
+        fetch_progress.finish(error=e)
+        return
+
+    with STORE_LOCK:
+        update_profile(provider, profile, result, fetch_progress.estimated_fields())
+        _CRAWLS.pop((provider, profile), None)
+    fetch_progress.finish(result=result)
+
+
+async def _fetch_profile_async(provider, fetch_async, profile, session, budget=None):
+    '''Async version of _fetch_profile, joining the crawl of the profile that is already running if any.
+
+    The crawl is shielded, so it still caches the profile if the request
+    that started it goes away or its budget runs out.
+    '''
+    key = (provider, profile)
+    crawl = _ASYNC_CRAWLS.get(key)
+    if crawl is None:
+        fetch_progress = FetchProgress()
+        task = asyncio.ensure_future(_crawl_async(provider, fetch_async, profile, session, fetch_progress))
+        crawl = _ASYNC_CRAWLS[key] = (task, fetch_progress)
+    task, fetch_progress = crawl
+
+    try:
+        await asyncio.wait_for(asyncio.shield(task), budget)
+    except asyncio.TimeoutError:
+        # the crawl may have finished between the timeout and now
+        if profile not in _profiles(provider):
+            cache_profile(provider, profile, *fetch_progress.partial_profile(COUNT_FIELDS))
+
+
+async def _crawl_async(provider, fetch_async, profile, session, fetch_progress):
+    try:
+        fetched, partial = await _fetch_async(fetch_async, profile, session, fetch_progress)
+    except Exception as e:
+        with STORE_LOCK:
+            # only set if a partial profile was cached when the budget ran out
+            if (provider, profile) in PARTIAL_PROFILES:
+                PARTIAL_PROFILES[(provider, profile)]['error'] = str(e)
+                owner = _find_owner(provider, profile)
+                if owner is not None:
+                    _bump_version(owner)
+        raise
+    finally:
+        _ASYNC_CRAWLS.pop((provider, profile), None)
+    update_profile(provider, profile, fetched, partial)
+
+
+def restore_version_counter():
+    '''Continue numbering after the highest version in USER_VERSIONS, e.g. after loading a snapshot.'''
+    global _version_counter
+    latest = max((version['version'] for version in USER_VERSIONS.values()), default=0)
+    _version_counter = count(latest + 1)
+
+
+def _bump_version(username):
+    last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+    previous = USER_VERSIONS.get(username)
+    USER_VERSIONS[username] = {
+        'version': next(_version_counter),
+        'epoch': EPOCH,
+        'last_modified': last_modified,
+        # Last-Modified only has one second resolution, so a change in the
+        # same second as the previous one can't be told apart from it
+        'same_second': previous is not None and previous['last_modified'] == last_modified,
+    }
+
+
+def _index_user(username):
+    '''Add a freshly created user to every leaderboard with zero counts.'''
+    for metric in COUNT_FIELDS:
+        LEADERBOARDS[metric].set(username, 0)
+    _bump_version(username)
+
+
+def _unindex_user(username):
+    for metric in COUNT_FIELDS:
+        LEADERBOARDS[metric].remove(username)
+    USER_VERSIONS.pop(username)
+
+
+def _on_profile_attached(username, profile):
+    '''Apply a profile's counts to the indexes of the user it was attached to.'''
+    for metric in COUNT_FIELDS:
+        LEADERBOARDS[metric].increment(username, profile[metric])
+    LANGUAGE_INDEX.add(username, profile['languages'])
+    TOPIC_INDEX.add(username, profile['repo_topics'])
+    _bump_version(username)
+
+
+def _on_profile_detached(username, profile):
+    '''Remove a profile's counts from the indexes of the user it was attached to.'''
+    for metric in COUNT_FIELDS:
+        LEADERBOARDS[metric].increment(username, -profile[metric])
+    LANGUAGE_INDEX.remove(username, profile['languages'])
+    TOPIC_INDEX.remove(username, profile['repo_topics'])
+    _bump_version(username)
+
+
+def _attach_profile(provider, profiles, username, profile):
+    '''Attach a profile that has already been fetched into profiles to username.'''
+    with STORE_LOCK:
+        # checked again because the user can be deleted while a fetch is in flight
+        if username not in USERS:
+            return {'msg': f'user {username} not found'}, 404
+
+        owner = _find_owner(provider, profile)
+        if owner is not None:
+            return {'msg': f'{provider} profile {profile} already attached to {owner}'}, 409
+        USERS[username][provider].add(profile)
+        _on_profile_attached(username, profiles[profile])
+        response = {'msg': f'added {provider} profile {profile} to {username}'}
+        if (provider, profile) in PARTIAL_PROFILES:
+            response['partial'] = PARTIAL_PROFILES[(provider, profile)]
+        return response, 201
+
+
+def _check_attached(provider, username, profile):
+    '''Return an error response if profile isn't attached to username, otherwise None.'''
+    if username not in USERS:
+        return {'msg': f'user {username} not found'}, 404
+    if profile not in USERS[username][provider]:
+        return {'msg': f'{profile} not attached to user {username}'}, 404
+    return None
+
+
+def _replace_profile(provider, profiles, username, profile, fresh_profile, partial=None, fetched=True):
+    '''Swap in a re-fetched profile and move its counts over in the indexes.'''
+    with STORE_LOCK:
+        error = _check_attached(provider, username, profile)
+        if error:
+            return error
+
+        _on_profile_detached(username, profiles[profile])
+        cache_profile(provider, profile, fresh_profile, partial, fetched)
+        _on_profile_attached(username, fresh_profile)
+        return {'msg': f'refreshed {provider} profile {profile} for {username}'}, 200
+
+
+def _refresh_profile(provider, profiles, fetch, username, profile):
+    '''Re-fetch an attached profile and replace the cached copy.'''
+    error = _check_attached(provider, username, profile)
+    if error:
+        return error
+    return _replace_profile(provider, profiles, username, profile, *_fetch(fetch, profile))
+
+
+def _find_owner(provider, profile):
+    '''Return the username a profile is attached to, or None.'''
+    for username, user_profiles in USERS.items():
+        if profile in user_profiles[provider]:
+            return username
+    return None
+
+
+def update_profile(provider, name, profile, partial=None, fetched=True):
+    '''Cache a fetched profile, moving its counts in the indexes if it is attached to a user.
+
+    partial and fetched are passed on to cache_profile.
+    '''
+    with STORE_LOCK:
+        owner = _find_owner(provider, name)
+        if owner is None:
+            cache_profile(provider, name, profile, partial, fetched)
+        else:
+            _replace_profile(provider, _profiles(provider), owner, name, profile, partial, fetched)
+
+
+async def _refresh_profile_async(provider, profiles, fetch_async, username, profile, session):
+    error = _check_attached(provider, username, profile)
+    if error:
+        return error
+    fresh_profile, partial = await _fetch_async(fetch_async, profile, session)
+    return _replace_profile(provider, profiles, username, profile, fresh_profile, partial)
 
 
 # not capitalizing these classes is kind of a smell,
@@ -12,22 +347,36 @@ class user:
     @staticmethod
     def create(username):
         '''Create a username.'''
-        if username in USERS:
-            return {'msg': f'user {username} already exists'}, 409
-        USERS[username] = {
-            'bitbucket': set(),
-            'github': set()
-        }
-        return {'msg': f'user {username} created'}, 201
+        with STORE_LOCK:
+            if username in USERS:
+                return {'msg': f'user {username} already exists'}, 409
+            USERS[username] = {
+                'bitbucket': set(),
+                'github': set()
+            }
+            _index_user(username)
+            return {'msg': f'user {username} created'}, 201
 
     @staticmethod
     def delete(username):
         '''Delete a username.'''
-        try:
-            USERS.pop(username)
+        with STORE_LOCK:
+            try:
+                profiles = USERS.pop(username)
+            except KeyError:
+                return {'msg': f'user {username} not found'}, 404
+
+            for profile in profiles['bitbucket']:
+                _on_profile_detached(username, BITBUCKET_PROFILES[profile])
+            for profile in profiles['github']:
+                _on_profile_detached(username, GITHUB_PROFILES[profile])
+            _unindex_user(username)
             return {'msg': f'user {username} deleted successfully'}, 200
-        except KeyError:
-            return {'msg': f'user {username} not found'}, 404
+
+    @staticmethod
+    def version(username):
+        '''Return a dict with the version and last modified time of a username, or None.'''
+        return USER_VERSIONS.get(username)
 
     @staticmethod
     def get(username):
@@ -64,14 +413,24 @@ class user:
                 merged_profile['total_source_commit_count'] += profile['total_source_commit_count']
                 merged_profile['watcher_count'] += profile['watcher_count']
 
-                merged_profile['repo_topics'] = merged_profile['repo_topics'].union(profile['repo_topics'])
-                merged_profile['languages'] = merged_profile['languages'].union(profile['languages'])
+                merged_profile['repo_topics'].update(profile['repo_topics'])
+                merged_profile['languages'].update(profile['languages'])
 
             merged_profile['language_count'] = len(merged_profile['languages'])
             merged_profile['languages'] = sorted(merged_profile['languages'])
             merged_profile['repo_topics_count'] = len(merged_profile['repo_topics'])
             merged_profile['repo_topics'] = sorted(merged_profile['repo_topics'])
 
+            # flag profiles whose crawl is still running in the background
+            partial = {
+                f'{provider}/{profile}': PARTIAL_PROFILES[(provider, profile)]
+                for provider in ('bitbucket', 'github')
+                for profile in USERS[username][provider]
+                if (provider, profile) in PARTIAL_PROFILES
+            }
+            if partial:
+                merged_profile['partial'] = partial
+
             return merged_profile, 200
         else:
             return {'msg': f'user {username} not found'}, 404
@@ -79,58 +438,174 @@ class user:
 
 class bitbucket:
     @staticmethod
-    def add(username, profile):
-        '''Add a bitbucket profile to a username'''
+    def add(username, profile, budget=None):
+        '''Add a bitbucket profile to a username
+
+        With a budget in seconds, a profile that takes longer to crawl is attached
+        with partial results and completed in the background.
+        '''
         if username not in USERS:
             return {'msg': f'user {username} not found'}, 404
 
         # add profile to profiles always because api operations are expensive
         if profile not in BITBUCKET_PROFILES:
-            BITBUCKET_PROFILES[profile] = get_bitbucket_profile(profile)
+            _fetch_profile('bitbucket', get_bitbucket_profile, profile, budget)
+
+        return _attach_profile('bitbucket', BITBUCKET_PROFILES, username, profile)
+
+    @staticmethod
+    async def add_async(username, profile, session, budget=None):
+        '''Add a bitbucket profile to a username without blocking on the bitbucket API.
+
+        budget works the same as for add.
+        '''
+        if username not in USERS:
+            return {'msg': f'user {username} not found'}, 404
+
+        if profile not in BITBUCKET_PROFILES:
+            await _fetch_profile_async('bitbucket', get_bitbucket_profile_async, profile, session, budget)
 
-        for user_profile_name, profiles in USERS.items():
-            if profile in profiles['bitbucket']:
-                return {'msg': f'bitbucket profile {profile} already attached to {user_profile_name}'}, 409
-        USERS[username]['bitbucket'].add(profile)
-        return {'msg': f'added bitbucket profile {profile} to {username}'}, 201
+        return _attach_profile('bitbucket', BITBUCKET_PROFILES, username, profile)
 
     @staticmethod
     def delete(username, profile):
         '''Delete a bitbucket profile from a username.'''
-        if username in USERS:
-            try:
-                USERS[username]['bitbucket'].remove(profile)
+        with STORE_LOCK:
+            if username in USERS:
+                try:
+                    USERS[username]['bitbucket'].remove(profile)
+                except KeyError:
+                    return {'msg': f'{profile} not attached to user {username}'}, 404
+                _on_profile_detached(username, BITBUCKET_PROFILES[profile])
                 return {'msg': f'removed {profile} from user {username}'}, 200
-            except KeyError:
-                return {'msg': f'{profile} not attached to user {username}'}, 404
-        else:
-            return {'msg': f'user {username} not found'}, 404
+            else:
+                return {'msg': f'user {username} not found'}, 404
+
+    @staticmethod
+    def refresh(username, profile):
+        '''Re-fetch a bitbucket profile attached to a username.'''
+        return _refresh_profile('bitbucket', BITBUCKET_PROFILES, get_bitbucket_profile, username, profile)
+
+    @staticmethod
+    async def refresh_async(username, profile, session):
+        '''Re-fetch a bitbucket profile attached to a username without blocking on the bitbucket API.'''
+        return await _refresh_profile_async(
+            'bitbucket', BITBUCKET_PROFILES, get_bitbucket_profile_async, username, profile, session
+        )
 
 
 class github:
     @staticmethod
-    def add(username, profile):
-        '''Add a github profile to a username.'''
+    def add(username, profile, budget=None):
+        '''Add a github profile to a username.
+
+        With a budget in seconds, a profile that takes longer to crawl is attached
+        with partial results and completed in the background.
+        '''
+        if username not in USERS:
+            return {'msg': f'user {username} not found'}, 404
+
+        if profile not in GITHUB_PROFILES:
+            _fetch_profile('github', get_github_profile, profile, budget)
+
+        return _attach_profile('github', GITHUB_PROFILES, username, profile)
+
+    @staticmethod
+    async def add_async(username, profile, session, budget=None):
+        '''Add a github profile to a username without blocking on the github API.
+
+        budget works the same as for add.
+        '''
         if username not in USERS:
             return {'msg': f'user {username} not found'}, 404
 
         if profile not in GITHUB_PROFILES:
-            GITHUB_PROFILES[profile] = get_github_profile(profile)
+            await _fetch_profile_async('github', get_github_profile_async, profile, session, budget)
 
-        for user_profile_name, profiles in USERS.items():
-            if profile in profiles['github']:
-                return {'msg': f'github profile {profile} already attached to {user_profile_name}'}, 409
-        USERS[username]['github'].add(profile)
-        return {'msg': f'added github profile {profile} to {username}'}, 201
+        return _attach_profile('github', GITHUB_PROFILES, username, profile)
 
     @staticmethod
     def delete(username, profile):
         '''Delete a github profile to a username.'''
-        if username in USERS:
-            try:
-                USERS[username]['github'].remove(profile)
+        with STORE_LOCK:
+            if username in USERS:
+                try:
+                    USERS[username]['github'].remove(profile)
+                except KeyError:
+                    return {'msg': f'{profile} not attached to user {username}'}, 404
+                _on_profile_detached(username, GITHUB_PROFILES[profile])
                 return {'msg': f'removed {profile} from user {username}'}, 200
-            except KeyError:
-                return {'msg': f'{profile} not attached to user {username}'}, 404
+            else:
+                return {'msg': f'user {username} not found'}, 404
+
+    @staticmethod
+    def refresh(username, profile):
+        '''Re-fetch a github profile attached to a username.'''
+        return _refresh_profile('github', GITHUB_PROFILES, get_github_profile, username, profile)
+
+    @staticmethod
+    async def refresh_async(username, profile, session):
+        '''Re-fetch a github profile attached to a username without blocking on the github API.'''
+        return await _refresh_profile_async(
+            'github', GITHUB_PROFILES, get_github_profile_async, username, profile, session
+        )
+
+
+class leaderboard:
+    @staticmethod
+    def get(metric, limit=10, username=None):
+        '''Get the top users for a metric, and optionally the rank of a single user.'''
+        if metric not in LEADERBOARDS:
+            return {'msg': f'unsupported leaderboard metric {metric}'}, 400
+        if limit < 1:
+            return {'msg': 'limit must be a positive integer'}, 400
+
+        index = LEADERBOARDS[metric]
+        leaders = [
+            {'rank': rank, 'username': name, 'value': value}
+            for rank, (name, value) in enumerate(index.top(limit), start=1)
+        ]
+        response = {'metric': metric, 'leaders': leaders}
+
+        if username is not None:
+            if username not in index:
+                return {'msg': f'user {username} not found'}, 404
+            response['user'] = {
+                'rank': index.rank(username),
+                'username': username,
+                'value': index.score(username),
+            }
+        return response, 200
+
+
+class search:
+    @staticmethod
+    def get(languages=(), topics=(), mode='and', limit=20, offset=0):
+        '''Find users by the languages and repo topics of their attached profiles.'''
+        if mode not in ('and', 'or'):
+            return {'msg': f'unsupported search mode {mode}'}, 400
+        if not languages and not topics:
+            return {'msg': 'at least one language or topic is required'}, 400
+        if limit < 1 or offset < 0:
+            return {'msg': 'limit must be positive and offset must not be negative'}, 400
+
+        # profiles store languages lowercased
+        languages = [language.lower() for language in languages]
+
+        if mode == 'and':
+            matches = None
+            if languages:
+                matches = LANGUAGE_INDEX.match_all(languages)
+            if topics:
+                topic_matches = TOPIC_INDEX.match_all(topics)
+                matches = topic_matches if matches is None else matches & topic_matches
         else:
-            return {'msg': f'user {username} not found'}, 404
+            matches = LANGUAGE_INDEX.match_any(languages) | TOPIC_INDEX.match_any(topics)
+
+        usernames = sorted(matches)
+        return {
+            'users': usernames[offset:offset + limit],
+            'total': len(usernames),
+            'limit': limit,
+            'offset': offset,
+        }, 200
@@ -1,6 +1,9 @@
+import asyncio
 import os
-import requests
+import upstream
+import columnar
 from collections import Counter
+from progress import sum_over_repos, sum_over_repos_async
 from urllib.parse import urlparse, parse_qs
 
 GITHUB_API_URL = 'https://api.github.com'
@@ -20,14 +23,46 @@ class GithubAPIException(Exception):
     pass
 
 
-def get_profile(profile):
-    '''Takes a user profile and returns a dictionary containing information about their user account.'''
+def _get(url, endpoint):
+    '''GET url from the github API through upstream's retries, circuit breaker and hedging.'''
+    return upstream.get(url, DEFAULT_API_HEADERS, f'github.{endpoint}', GithubAPIException)
+
+
+async def _get_async(session, url, endpoint):
+    '''Async version of _get for the fetchers used in async mode.'''
+    return await upstream.get_async(session, url, DEFAULT_API_HEADERS, f'github.{endpoint}', GithubAPIException)
+
+
+def get_profile(profile, progress=None):
+    '''Takes a user profile and returns a dictionary containing information about their user account.
+
+    If a progress.FetchProgress is passed, fields are reported to it as soon as they are known.
+    '''
     repos = get_repos(profile)
     repo_stats = get_repo_stats(repos)
+    if progress:
+        progress.record(
+            public_source_repositories=repo_stats['source_repos'],
+            public_fork_repositories=repo_stats['forked_repos'],
+            watcher_count=repo_stats['watchers'],
+            stars_received=repo_stats['stars_received'],
+            total_open_issues=repo_stats['open_issues'],
+            total_account_size=repo_stats['size'],
+            languages=repo_stats['languages'],
+            repo_topics=repo_stats['topics'],
+        )
+
     starred_repos = get_starred_repos_count(profile)
     follower_count = get_follower_count(profile)
-    commit_count = get_commit_count(profile, repos)
+    if progress:
+        progress.record(stars_given=starred_repos, follower_count=follower_count)
 
+    commit_count = get_commit_count(profile, repos, progress=progress)
+    return _build_profile(repo_stats, starred_repos, follower_count, commit_count)
+
+
+def _build_profile(repo_stats, starred_repos, follower_count, commit_count):
+    '''Takes the aggregated API results for a profile and returns the profile dictionary.'''
     result = {
         'public_source_repositories': repo_stats['source_repos'],
         'public_fork_repositories': repo_stats['forked_repos'],
@@ -51,7 +86,7 @@ def get_repos(profile):
     url = f"{GITHUB_API_URL}/users/{profile}/repos"
     repos = []
     while True:
-        resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+        resp = _get(url, 'repos')
         if resp.ok:
             repos.extend(resp.json())
         else:
@@ -66,6 +101,9 @@ def get_repos(profile):
 
 def get_repo_stats(repos):
     '''Take a list of repos return a dictionary of aggregated stats for the repos.'''
+    if columnar.available and len(repos) >= columnar.MIN_REPOS:
+        return columnar.github_repo_stats(repos)
+
     counts = Counter()
     languages = set()
     topics = set()
@@ -106,18 +144,21 @@ def get_repo_stats(repos):
     }
 
 
-def get_commit_count(profile, repos):
-    commit_count = 0
-    for repo in repos:
-        if not repo['fork']:
-            commit_count += _get_repo_commit_count(profile, repo['name'])
-    return commit_count
+def get_commit_count(profile, repos, progress=None):
+    '''Sum the commits of the source repos, estimating around repos whose count fails.'''
+    return sum_over_repos(
+        lambda repo: _get_repo_commit_count(profile, repo['name']),
+        [repo for repo in repos if not repo['fork']],
+        'total_source_commit_count',
+        progress,
+        skip=GithubAPIException,
+    )
 
 
 def _get_repo_commit_count(profile, repo):
     '''Takes a user profile and and repository and returns the number of commits to that repository.'''
     url = f'{GITHUB_API_URL}/repos/{profile}/{repo}/commits?per_page=1'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'commits')
 
     if resp.ok is False:
         raise GithubAPIException(f'There was an error retrieving commit count. Status: {resp.status_code}')
@@ -128,7 +169,7 @@ def _get_repo_commit_count(profile, repo):
 def get_starred_repos_count(profile):
     '''Takes a user profile name and returns the number of repos that user has starred.'''
     url = f'{GITHUB_API_URL}/users/{profile}/starred?per_page=1'
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'starred')
 
     if resp.ok is False:
         raise GithubAPIException(f'There was an error retrieving starred repo count. Status: {resp.status_code}')
@@ -140,7 +181,7 @@ def get_follower_count(profile):
     '''Takes a user profile and returns the number of follwers they have'''
     url = f'{GITHUB_API_URL}/users/{profile}/followers?per_page=1'
 
-    resp = requests.get(url, headers=DEFAULT_API_HEADERS)
+    resp = _get(url, 'followers')
 
     if resp.ok is False:
         raise GithubAPIException(f'There was an error retriving follower count. Status: {resp.status_code}')
@@ -160,3 +201,87 @@ def parse_count_from_response(resp):
         # no last page to use, check length of result
         count = len(resp.json())
     return count
+
+
+# Async versions of the fetchers above, used when the API runs in async mode.
+# They share the pure aggregation helpers with the blocking versions, but
+# issue the per repo requests concurrently (up to async_http.MAX_REPO_REQUESTS
+# at a time) instead of one after another.
+async def get_profile_async(profile, session, progress=None):
+    '''Takes a user profile and an aiohttp session and returns the same dictionary as get_profile.'''
+    repos = await get_repos_async(profile, session)
+    repo_stats = get_repo_stats(repos)
+    if progress:
+        progress.record(
+            public_source_repositories=repo_stats['source_repos'],
+            public_fork_repositories=repo_stats['forked_repos'],
+            watcher_count=repo_stats['watchers'],
+            stars_received=repo_stats['stars_received'],
+            total_open_issues=repo_stats['open_issues'],
+            total_account_size=repo_stats['size'],
+            languages=repo_stats['languages'],
+            repo_topics=repo_stats['topics'],
+        )
+
+    starred_repos, follower_count, commit_count = await asyncio.gather(
+        get_starred_repos_count_async(profile, session),
+        get_follower_count_async(profile, session),
+        get_commit_count_async(profile, repos, session, progress=progress),
+    )
+    return _build_profile(repo_stats, starred_repos, follower_count, commit_count)
+
+
+async def get_repos_async(profile, session):
+    url = f"{GITHUB_API_URL}/users/{profile}/repos"
+    repos = []
+    while True:
+        resp = await _get_async(session, url, 'repos')
+        if resp.ok:
+            repos.extend(resp.json())
+        else:
+            raise GithubAPIException(f'Error calling repos API. Status code: {resp.status_code}')
+        try:
+            url = resp.links['next']['url']
+        except KeyError:
+            break
+    return repos
+
+
+async def get_commit_count_async(profile, repos, session, progress=None):
+    return await sum_over_repos_async(
+        lambda repo: _get_repo_commit_count_async(profile, repo['name'], session),
+        [repo for repo in repos if not repo['fork']],
+        'total_source_commit_count',
+        progress,
+        skip=GithubAPIException,
+    )
+
+
+async def _get_repo_commit_count_async(profile, repo, session):
+    url = f'{GITHUB_API_URL}/repos/{profile}/{repo}/commits?per_page=1'
+    resp = await _get_async(session, url, 'commits')
+
+    if resp.ok is False:
+        raise GithubAPIException(f'There was an error retrieving commit count. Status: {resp.status_code}')
+
+    return parse_count_from_response(resp)
+
+
+async def get_starred_repos_count_async(profile, session):
+    url = f'{GITHUB_API_URL}/users/{profile}/starred?per_page=1'
+    resp = await _get_async(session, url, 'starred')
+
+    if resp.ok is False:
+        raise GithubAPIException(f'There was an error retrieving starred repo count. Status: {resp.status_code}')
+
+    return parse_count_from_response(resp)
+
+
+async def get_follower_count_async(profile, session):
+    url = f'{GITHUB_API_URL}/users/{profile}/followers?per_page=1'
+    resp = await _get_async(session, url, 'followers')
+
+    if resp.ok is False:
+        raise GithubAPIException(f'There was an error retriving follower count. Status: {resp.status_code}')
+
+    return parse_count_from_response(resp)
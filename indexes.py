@@ -0,0 +1,89 @@
+from bisect import bisect_left, insort
+
+
+class SortedIndex:
+    '''Keeps keys ordered by a numeric score, highest score first.
+
+    Entries are stored as (-score, key) tuples in a sorted list so that
+    bisect can find a key's position without scanning. Ties are broken by key.
+    '''
+
+    def __init__(self):
+        self._scores = {}
+        self._entries = []
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, key):
+        return key in self._scores
+
+    def score(self, key):
+        return self._scores[key]
+
+    def set(self, key, score):
+        '''Insert key with score, or move it if it is already indexed.'''
+        if key in self._scores:
+            self.remove(key)
+        self._scores[key] = score
+        insort(self._entries, (-score, key))
+
+    def increment(self, key, amount):
+        self.set(key, self._scores.get(key, 0) + amount)
+
+    def remove(self, key):
+        score = self._scores.pop(key)
+        position = bisect_left(self._entries, (-score, key))
+        del self._entries[position]
+
+    def rank(self, key):
+        '''Return the 1-based rank of key.'''
+        return bisect_left(self._entries, (-self._scores[key], key)) + 1
+
+    def top(self, limit):
+        '''Return a list of (key, score) tuples for the highest scores.'''
+        return [(key, -score) for score, key in self._entries[:limit]]
+
+
+class InvertedIndex:
+    '''Maps terms to the keys that contain them.
+
+    A key can be added with the same term more than once (e.g. a user with
+    two attached profiles that both use python), so each posting keeps a
+    reference count and the key is only dropped when the count reaches zero.
+    '''
+
+    def __init__(self):
+        self._postings = {}
+
+    def add(self, key, terms):
+        for term in terms:
+            posting = self._postings.setdefault(term, {})
+            posting[key] = posting.get(key, 0) + 1
+
+    def remove(self, key, terms):
+        for term in terms:
+            posting = self._postings[term]
+            posting[key] -= 1
+            if posting[key] == 0:
+                del posting[key]
+            if not posting:
+                del self._postings[term]
+
+    def match_all(self, terms):
+        '''Return the keys that contain every one of terms.'''
+        # intersect starting from the smallest posting to keep sets small
+        postings = sorted((self._postings.get(term, {}) for term in terms), key=len)
+        if not postings:
+            return set()
+        keys = set(postings[0])
+        for posting in postings[1:]:
+            keys.intersection_update(posting)
+        return keys
+
+    def match_any(self, terms):
+        '''Return the keys that contain at least one of terms.'''
+        keys = set()
+        for term in terms:
+            keys.update(self._postings.get(term, ()))
+        return keys
@@ -0,0 +1,367 @@
+'''Load test the API with a mix of create/attach/detach/get requests.
+
+The upstream github/bitbucket fetchers are replaced with stubs that build
+synthetic profiles, so only the API itself is measured. The store is seeded
+with --users users and --profiles profiles per provider (attached round
+robin), plus --unattached profiles per provider that attach picks from. Half
+of those are cached up front and half are fetched (through the stub) when
+first attached. Then --concurrency workers send requests for --duration
+seconds. Attach and detach keep track of which profiles are attached to
+whom, so they mostly get 201/200 rather than 409/404. Throughput and
+p50/p95/p99 latency are reported per route.
+
+    python loadtest.py --users 1000 --profiles 2000 --concurrency 16 --duration 10
+    python loadtest.py --transport http --mix get=90,attach=5,detach=5
+    python loadtest.py --mode async --mix get=90,attach=5,detach=5
+
+The default transport calls the app through Flask's test client in this
+process. --transport http serves the app with werkzeug's threaded server on
+a local port and sends real HTTP requests to it. --mode async serves the
+Quart app from async_main.py with hypercorn instead, always over HTTP, so
+the two serving modes can be compared; it needs quart, aiohttp and
+hypercorn installed.
+'''
+import argparse
+import asyncio
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import db
+import main
+
+PROVIDERS = ('bitbucket', 'github')
+LANGUAGES = ['python', 'go', 'rust', 'java', 'javascript', 'html', 'c++', 'ruby', 'haskell', 'elixir']
+DEFAULT_MIX = 'get=70,attach=10,detach=10,create=10'
+
+
+def stub_profile(name, progress=None):
+    '''Build a synthetic but deterministic profile for a profile name.'''
+    rng = random.Random(name)
+    languages = set(rng.sample(LANGUAGES, rng.randint(1, 5)))
+    topics = {f'topic{rng.randint(0, 500)}' for _ in range(rng.randint(0, 30))}
+    profile = {field: rng.randint(0, 5000) for field in db.COUNT_FIELDS}
+    profile.update({
+        'languages': languages,
+        'language_count': len(languages),
+        'repo_topics': topics,
+        'repo_topics_count': len(topics),
+    })
+    return profile
+
+
+async def stub_profile_async(name, session, progress=None):
+    return stub_profile(name, progress)
+
+
+def parse_mix(mix):
+    '''Parse "get=70,attach=10" into ([operations], [weights]).'''
+    operations, weights = [], []
+    for part in mix.split(','):
+        operation, weight = part.split('=')
+        if operation not in OPERATIONS:
+            raise ValueError(f'unknown operation {operation}, expected one of {", ".join(OPERATIONS)}')
+        operations.append(operation)
+        weights.append(float(weight))
+    return operations, weights
+
+
+def seed(users, profiles, unattached):
+    '''Create users, attach profiles to them round robin and return the pools attach/detach pick from.
+
+    Returns (attached, unattached): lists of (provider, profile, username)
+    and (provider, profile).
+    '''
+    attached_pool = []
+    unattached_pool = []
+    for i in range(users):
+        db.user.create(f'user{i}')
+    for i in range(profiles):
+        username = f'user{i % users}'
+        db.bitbucket.add(username, f'bb{i}')
+        db.github.add(username, f'gh{i}')
+        attached_pool += [('bitbucket', f'bb{i}', username), ('github', f'gh{i}', username)]
+    for i in range(profiles, profiles + unattached):
+        for provider, name in (('bitbucket', f'bb{i}'), ('github', f'gh{i}')):
+            # the other half is fetched by the first attach
+            if i % 2 == 0:
+                db.cache_profile(provider, name, stub_profile(name))
+            unattached_pool.append((provider, name))
+    return attached_pool, unattached_pool
+
+
+class HTTPClient:
+    '''Sends requests to a running server with the same interface as the Flask test client.'''
+
+    def __init__(self, base_url):
+        import requests
+        self._session = requests.Session()
+        self._base_url = base_url
+
+    def open(self, path, method):
+        return self._session.request(method, f'{self._base_url}{path}')
+
+
+class FlaskClient:
+    def __init__(self):
+        self._client = main.app.test_client()
+
+    def open(self, path, method):
+        return self._client.open(path, method=method)
+
+
+def _serve_sync():
+    '''Serve main.app with werkzeug on a local port from a daemon thread. Returns (base url, stop).'''
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server.shutdown
+
+
+def _serve_async():
+    '''Serve async_main.app with hypercorn on a local port from a daemon thread. Returns (base url, stop).'''
+    import async_main
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    # listening right away queues requests sent before hypercorn accepts them
+    sock.listen()
+    port = sock.getsockname()[1]
+    config = Config()
+    config.bind = [f'fd://{sock.detach()}']
+    config.accesslog = None
+    config.loglevel = 'WARNING'
+
+    loop = asyncio.new_event_loop()
+    stopped = asyncio.Event()
+
+    def run():
+        loop.run_until_complete(serve(async_main.app, config, shutdown_trigger=stopped.wait))
+        loop.close()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(stopped.set)
+        thread.join()
+    return f'http://127.0.0.1:{port}', stop
+
+
+def _take(rng, pool):
+    '''Remove and return a random item of a list.'''
+    i = rng.randrange(len(pool))
+    pool[i], pool[-1] = pool[-1], pool[i]
+    return pool.pop()
+
+
+# Each operation returns (route, method, path, done). done is called with the
+# status code of the response, or is None.
+def op_get(rng, state):
+    return 'GET /user/<username>', 'GET', f'/user/user{rng.randrange(state["users"])}', None
+
+
+def op_create(rng, state):
+    with state['lock']:
+        state['created'] += 1
+        username = f'loadtest{state["created"]}'
+    return 'POST /user/<username>', 'POST', f'/user/{username}', None
+
+
+def _made_up_profile(rng, state):
+    '''Return (provider, profile) for a profile no request has used yet. Call with state['lock'] held.'''
+    provider = rng.choice(PROVIDERS)
+    state['made_up'] += 1
+    return provider, f'{"bb" if provider == "bitbucket" else "gh"}new{state["made_up"]}'
+
+
+def op_attach(rng, state):
+    username = f'user{rng.randrange(state["users"])}'
+    # the profile is out of both pools until its request is done, so no
+    # other worker detaches it in the meantime
+    with state['lock']:
+        if state['attached'] and not state['unattached']:
+            # everything is attached, this one will get a 409
+            provider, profile, _ = rng.choice(state['attached'])
+            done = None
+        else:
+            # every profile can be in flight, then a new one is fetched
+            if state['unattached']:
+                provider, profile = _take(rng, state['unattached'])
+            else:
+                provider, profile = _made_up_profile(rng, state)
+
+            def done(status_code):
+                with state['lock']:
+                    if status_code == 201:
+                        state['attached'].append((provider, profile, username))
+                    else:
+                        state['unattached'].append((provider, profile))
+    return f'POST /user/<username>/{provider}/<profile>', 'POST', f'/user/{username}/{provider}/{profile}', done
+
+
+def op_detach(rng, state):
+    with state['lock']:
+        if not state['attached']:
+            # nothing is attached (or it all is in flight), this one will get a 404
+            if state['unattached']:
+                provider, profile = rng.choice(state['unattached'])
+            else:
+                provider, profile = _made_up_profile(rng, state)
+            username = f'user{rng.randrange(state["users"])}'
+            done = None
+        else:
+            provider, profile, username = _take(rng, state['attached'])
+
+            def done(status_code):
+                with state['lock']:
+                    if status_code == 200:
+                        state['unattached'].append((provider, profile))
+                    else:
+                        state['attached'].append((provider, profile, username))
+    route = f'DELETE /user/<username>/{provider}/<profile>'
+    return route, 'DELETE', f'/user/{username}/{provider}/{profile}', done
+
+
+OPERATIONS = {
+    'get': op_get,
+    'create': op_create,
+    'attach': op_attach,
+    'detach': op_detach,
+}
+
+
+def percentile(sorted_values, fraction):
+    '''Nearest rank percentile of an already sorted list.'''
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def worker(make_client, operations, weights, state, deadline, seed_value):
+    '''Send requests until deadline and return {route: [(latency, status code)]}.'''
+    rng = random.Random(seed_value)
+    client = make_client()
+    samples = defaultdict(list)
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        route, method, path, done = OPERATIONS[operation](rng, state)
+        started = time.perf_counter()
+        resp = client.open(path, method)
+        samples[route].append((time.perf_counter() - started, resp.status_code))
+        if done is not None:
+            done(resp.status_code)
+    return samples
+
+
+def run(users, profiles, concurrency, duration, mix=DEFAULT_MIX, transport='client', unattached=None, mode='sync'):
+    '''Seed the store, run the load and return a report dict keyed by route.
+
+    unattached defaults to the same number as profiles. mode='async' serves
+    async_main.app, which is only possible over HTTP.
+    '''
+    operations, weights = parse_mix(mix)
+    if unattached is None:
+        unattached = profiles
+    if mode == 'async' and transport != 'http':
+        raise ValueError('async mode is only served over http')
+
+    with patch('db.get_github_profile', stub_profile), patch('db.get_bitbucket_profile', stub_profile), \
+            patch('db.get_github_profile_async', stub_profile_async), \
+            patch('db.get_bitbucket_profile_async', stub_profile_async):
+        attached_pool, unattached_pool = seed(users, profiles, unattached)
+
+        stop = None
+        if transport == 'http':
+            base_url, stop = _serve_async() if mode == 'async' else _serve_sync()
+
+            def make_client():
+                return HTTPClient(base_url)
+        else:
+            make_client = FlaskClient
+
+        state = {
+            'users': users,
+            'attached': attached_pool,
+            'unattached': unattached_pool,
+            'created': 0,
+            'made_up': 0,
+            'lock': threading.Lock(),
+        }
+        started = time.monotonic()
+        deadline = started + duration
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [
+                    executor.submit(worker, make_client, operations, weights, state, deadline, i)
+                    for i in range(concurrency)
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            if stop is not None:
+                stop()
+        elapsed = time.monotonic() - started
+
+    samples = defaultdict(list)
+    for result in results:
+        for route, route_samples in result.items():
+            samples[route].extend(route_samples)
+
+    report = {}
+    for route, route_samples in sorted(samples.items()):
+        latencies = sorted(latency for latency, _ in route_samples)
+        statuses = defaultdict(int)
+        for _, status_code in route_samples:
+            statuses[status_code] += 1
+        report[route] = {
+            'requests': len(route_samples),
+            'throughput': len(route_samples) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'statuses': dict(sorted(statuses.items())),
+        }
+    return report
+
+
+def print_report(report):
+    total = sum(route['throughput'] for route in report.values())
+    print(f'{"route":<48} {"req":>8} {"req/s":>10} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}  statuses')
+    for route, stats in report.items():
+        statuses = ' '.join(f'{code}:{count}' for code, count in stats['statuses'].items())
+        print(
+            f'{route:<48} {stats["requests"]:>8} {stats["throughput"]:>10.1f} '
+            f'{stats["p50_ms"]:>9.2f} {stats["p95_ms"]:>9.2f} {stats["p99_ms"]:>9.2f}  {statuses}'
+        )
+    print(f'total: {total:.1f} req/s')
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the API with stubbed upstream APIs.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--profiles', type=int, default=2000, help='attached profiles to seed per provider')
+    parser.add_argument('--unattached', type=int, default=None,
+                        help='unattached profiles per provider for attach to pick from (default --profiles)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send requests for')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'operation weights (default {DEFAULT_MIX})')
+    parser.add_argument('--transport', choices=('client', 'http'),
+                        help='default client, or http with --mode async')
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync',
+                        help='serve main.app (sync) or async_main.app under hypercorn (async)')
+    args = parser.parse_args(argv)
+    transport = args.transport or ('http' if args.mode == 'async' else 'client')
+    if args.mode == 'async' and transport != 'http':
+        parser.error('--mode async needs --transport http')
+
+    report = run(
+        args.users, args.profiles, args.concurrency, args.duration, args.mix, transport, args.unattached, args.mode
+    )
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,37 +1,169 @@
+import json
+import os
+
 import db
-from flask import Flask, jsonify, request
+import serializer
+import webhooks
+from flask import Flask, Response, request
 
 app = Flask(__name__)
 
+# serialized GET /user bodies keyed by username, stored with the version
+# of the user they were built from
+USER_RESPONSE_CACHE = {}
+
+
+def json_response(body, status_code, response_class=Response):
+    return response_class(serializer.dumps(body), status=status_code, mimetype='application/json')
+
+
+def get_user_response(username, request=request, response_class=Response):
+    '''Serve GET /user/<username> with conditional request support.
+
+    The ETag is the user's version, so a matching If-None-Match is answered
+    with a 304 without merging any profiles. Versions come from one counter
+    shared by all users, and are prefixed with the epoch of the process that
+    issued them since the counter restarts with it. If-Modified-Since is
+    only honoured when the last change is the only one in its second. The
+    request and response class are parameters so the async app can share this.
+    '''
+    version = db.user.version(username)
+    if version is None:
+        return json_response(*db.user.get(username), response_class=response_class)
+
+    etag = f'{version["epoch"]}-{version["version"]}'
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        since = request.if_modified_since
+        not_modified = since is not None and not version['same_second'] and version['last_modified'] <= since
+
+    if not_modified:
+        response = response_class(status=304)
+    else:
+        cached_version, body = USER_RESPONSE_CACHE.get(username, (None, None))
+        if cached_version != version['version']:
+            body = serializer.encode_user(username)
+            USER_RESPONSE_CACHE[username] = (version['version'], body)
+        response = response_class(body, status=200, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.last_modified = version['last_modified']
+    return response
+
 
 @app.route('/user/<username>', methods=['GET', 'POST', 'DELETE'])
 def user(username):
     if request.method == 'POST':
         resp_body, status_code = db.user.create(username)
     elif request.method == 'GET':
-        resp_body, status_code = db.user.get(username)
+        return get_user_response(username)
     elif request.method == 'DELETE':
         resp_body, status_code = db.user.delete(username)
-    return jsonify(resp_body), status_code
+        USER_RESPONSE_CACHE.pop(username, None)
+    return json_response(resp_body, status_code)
 
 
-@app.route("/user/<username>/bitbucket/<profile>", methods=['POST', 'DELETE'])
+@app.route("/user/<username>/bitbucket/<profile>", methods=['POST', 'PUT', 'DELETE'])
 def bitbucket_profile(username, profile):
     if request.method == 'POST':
-        response, status_code = db.bitbucket.add(username, profile)
+        budget = request.args.get('budget', type=float)
+        response, status_code = db.bitbucket.add(username, profile, budget)
+    elif request.method == 'PUT':
+        response, status_code = db.bitbucket.refresh(username, profile)
     elif request.method == 'DELETE':
         response, status_code = db.bitbucket.delete(username, profile)
-    return jsonify(response), status_code
+    return json_response(response, status_code)
 
 
-@app.route("/user/<username>/github/<profile>", methods=['POST', 'DELETE'])
+@app.route("/user/<username>/github/<profile>", methods=['POST', 'PUT', 'DELETE'])
 def github_profile(username, profile):
     if request.method == 'POST':
-        response, status_code = db.github.add(username, profile)
+        budget = request.args.get('budget', type=float)
+        response, status_code = db.github.add(username, profile, budget)
+    elif request.method == 'PUT':
+        response, status_code = db.github.refresh(username, profile)
     elif request.method == 'DELETE':
         response, status_code = db.github.delete(username, profile)
-    return jsonify(response), status_code
+    return json_response(response, status_code)
+
+
+@app.route('/leaderboard', methods=['GET'])
+def leaderboard():
+    metric = request.args.get('metric', 'stars_received')
+    limit = request.args.get('limit', 10, type=int)
+    username = request.args.get('username')
+    response, status_code = db.leaderboard.get(metric, limit, username)
+    return json_response(response, status_code)
+
+
+@app.route('/search', methods=['GET'])
+def search():
+    response, status_code = db.search.get(
+        languages=request.args.getlist('language'),
+        topics=request.args.getlist('topic'),
+        mode=request.args.get('mode', 'and'),
+        limit=request.args.get('limit', 20, type=int),
+        offset=request.args.get('offset', 0, type=int),
+    )
+    return json_response(response, status_code)
+
+
+# webhook payloads must carry a matching X-Hub-Signature-256 (github) or
+# X-Hub-Signature (bitbucket) header. Without a secret a provider's webhooks
+# are rejected, unless HDUB_ALLOW_UNSIGNED_WEBHOOKS=1 accepts them unsigned
+# (e.g. for local testing)
+WEBHOOK_SECRETS = {
+    'github': os.environ.get('GITHUB_WEBHOOK_SECRET'),
+    'bitbucket': os.environ.get('BITBUCKET_WEBHOOK_SECRET'),
+}
+ALLOW_UNSIGNED_WEBHOOKS = os.environ.get('HDUB_ALLOW_UNSIGNED_WEBHOOKS') == '1'
+
+
+def handle_webhook(provider, headers, body):
+    '''Verify and apply a raw webhook request, returning (response body, status code).'''
+    signature_header, event_header, handle = {
+        'github': ('X-Hub-Signature-256', 'X-GitHub-Event', webhooks.handle_github),
+        'bitbucket': ('X-Hub-Signature', 'X-Event-Key', webhooks.handle_bitbucket),
+    }[provider]
+
+    secret = WEBHOOK_SECRETS[provider]
+    if not secret:
+        if not ALLOW_UNSIGNED_WEBHOOKS:
+            return {'msg': f'no {provider} webhook secret is configured'}, 403
+    elif not webhooks.verify_signature(secret, body, headers.get(signature_header)):
+        return {'msg': 'invalid webhook signature'}, 401
+
+    event = headers.get(event_header)
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if not event or not isinstance(payload, dict):
+        return {'msg': f'expected a {event_header} header and a JSON body'}, 400
+    return handle(event, payload)
+
+
+@app.route('/webhooks/<any(github, bitbucket):provider>', methods=['POST'])
+def webhook(provider):
+    response, status_code = handle_webhook(provider, request.headers, request.get_data())
+    return json_response(response, status_code)
 
 
 if __name__ == "__main__":
-    app.run()
+    # HDUB_SNAPSHOT_PATH warm starts the store from a snapshot and keeps
+    # writing new ones every HDUB_SNAPSHOT_INTERVAL seconds
+    snapshot_path = os.environ.get('HDUB_SNAPSHOT_PATH')
+    if snapshot_path:
+        import snapshot
+        if os.path.exists(snapshot_path):
+            snapshot.load(snapshot_path)
+        snapshot.start_periodic(snapshot_path, int(os.environ.get('HDUB_SNAPSHOT_INTERVAL', 300)))
+
+    # HDUB_SERVER_MODE=async serves the same routes from async_main, where
+    # upstream fetches don't tie up a thread per request
+    if os.environ.get('HDUB_SERVER_MODE', 'sync') == 'async':
+        import async_main
+        async_main.app.run()
+    else:
+        app.run()
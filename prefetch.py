@@ -0,0 +1,126 @@
+'''Warm the profile cache ahead of time for a list of github/bitbucket profiles.
+
+The profile list has one `<provider> <profile>` pair per line (a comma works
+as a separator too); blank lines and lines starting with # are ignored:
+
+    github kennethreitz
+    bitbucket pygame
+
+Fetched profiles are written to a snapshot (see snapshot.py), which is
+checkpointed as the run goes. Re-running the same command resumes where it
+stopped, because profiles fetched within --max-age seconds are skipped.
+Start the API with HDUB_SNAPSHOT_PATH pointing at the snapshot afterwards
+so attaching those profiles doesn't have to hit the upstream APIs.
+
+--rate caps the upstream requests per second per provider; a single profile
+needs at least one request per repo. When a response says the upstream
+rate limit is used up, requests wait for it to reset (see upstream.py).
+
+    python prefetch.py profiles.txt --snapshot store.snapshot
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import snapshot
+import upstream
+from bitbucket import BitbucketAPIException
+from github import GithubAPIException
+
+PROVIDERS = ('bitbucket', 'github')
+
+
+def read_profile_list(path):
+    '''Return a list of (provider, profile) tuples from a profile list file.'''
+    pairs = []
+    with open(path) as profile_list:
+        for line_number, line in enumerate(profile_list, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.replace(',', ' ').split()
+            if len(parts) != 2 or parts[0] not in PROVIDERS:
+                raise ValueError(f'{path}:{line_number}: expected "<bitbucket|github> <profile>", got {line!r}')
+            pairs.append((parts[0], parts[1]))
+    # the same profile listed twice only needs fetching once
+    return list(dict.fromkeys(pairs))
+
+
+def prefetch(pairs, workers, rate, max_age, snapshot_path=None, checkpoint_every=100, out=sys.stderr):
+    '''Fetch every stale profile in pairs into the profile cache and return counts of the outcomes.
+
+    Every upstream request is rate limited to rate per second per provider,
+    on top of the pauses upstream.get makes when a rate limit is used up.
+    '''
+    pending = [(provider, profile) for provider, profile in pairs if not db.is_fresh(provider, profile, max_age)]
+    results = {'fetched': 0, 'failed': 0, 'skipped': len(pairs) - len(pending)}
+    print(f'{len(pairs)} profiles, {results["skipped"]} already fresh, fetching {len(pending)}', file=out)
+
+    previous_limiters = dict(upstream.RATE_LIMITERS)
+    upstream.RATE_LIMITERS.update({provider: upstream.RateLimiter(rate) for provider in PROVIDERS})
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(db.fetch_profile, provider, profile): (provider, profile)
+            for provider, profile in pending
+        }
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                provider, profile = futures[future]
+                try:
+                    # profiles are only stored from this thread, so db isn't touched concurrently
+                    db.update_profile(provider, profile, *future.result())
+                    results['fetched'] += 1
+                    status = 'ok'
+                except (BitbucketAPIException, GithubAPIException) as e:
+                    results['failed'] += 1
+                    status = f'failed: {e}'
+
+                throughput = done / (time.monotonic() - started)
+                print(f'[{done}/{len(pending)}] {provider}/{profile} {status} ({throughput:.2f} profiles/s)', file=out)
+
+                if snapshot_path and done % checkpoint_every == 0:
+                    snapshot.save(snapshot_path)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            print('interrupted, saving progress', file=out)
+            raise
+        finally:
+            upstream.RATE_LIMITERS.clear()
+            upstream.RATE_LIMITERS.update(previous_limiters)
+            if snapshot_path:
+                snapshot.save(snapshot_path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prefetch github/bitbucket profiles into a snapshot.')
+    parser.add_argument('profile_list', help='file with one "<provider> <profile>" pair per line')
+    parser.add_argument('--snapshot', required=True, help='snapshot to resume from and write to')
+    parser.add_argument('--workers', type=int, default=8, help='number of profiles fetched in parallel')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='max upstream requests per second, per provider (a profile takes one per repo or more)')
+    parser.add_argument('--max-rate-limit-wait', type=float, default=60 * 60,
+                        help='how long to wait for a used up upstream rate limit to reset before giving up')
+    parser.add_argument('--max-age', type=float, default=24 * 60 * 60,
+                        help='skip profiles fetched less than this many seconds ago')
+    parser.add_argument('--checkpoint-every', type=int, default=100,
+                        help='save the snapshot after this many profiles')
+    args = parser.parse_args(argv)
+
+    upstream.MAX_RATE_LIMIT_WAIT = args.max_rate_limit_wait
+    if os.path.exists(args.snapshot):
+        snapshot.load(args.snapshot)
+
+    pairs = read_profile_list(args.profile_list)
+    results = prefetch(pairs, args.workers, args.rate, args.max_age, args.snapshot, args.checkpoint_every)
+    print(f'fetched {results["fetched"]}, skipped {results["skipped"]}, failed {results["failed"]}', file=sys.stderr)
+    return 1 if results['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
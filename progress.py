@@ -0,0 +1,133 @@
+import threading
+
+import async_http
+
+
+def estimate(subtotal, covered, total):
+    '''Scale a sum over covered repos up to all total repos.'''
+    return round(subtotal * total / covered) if covered else 0
+
+
+def sum_over_repos(count_repo, repos, field, progress=None, skip=()):
+    '''Return the sum of count_repo(repo) over repos.
+
+    A repo whose count raises one of the skip exceptions (an open circuit
+    breaker, retries running out, an error status) is left out instead of
+    failing the whole crawl. The sum is then scaled up from the repos that
+    were counted, and progress reports the field as covering fewer repos
+    than there are, which marks it estimated.
+    '''
+    subtotal = 0
+    covered = 0
+    for repo in repos:
+        try:
+            subtotal += count_repo(repo)
+            covered += 1
+        except skip:
+            pass
+        if progress:
+            progress.record_repo(field, covered, len(repos), subtotal)
+    return estimate(subtotal, covered, len(repos))
+
+
+async def sum_over_repos_async(count_repo, repos, field, progress=None, skip=()):
+    '''Async version of sum_over_repos, counting repos concurrently with async_http.gather_bounded.'''
+    counted = {'subtotal': 0, 'covered': 0}
+
+    async def count(repo):
+        try:
+            # awaited before adding, so concurrent counts don't overwrite each other
+            value = await count_repo(repo)
+            counted['subtotal'] += value
+            counted['covered'] += 1
+        except skip:
+            pass
+        if progress:
+            progress.record_repo(field, counted['covered'], len(repos), counted['subtotal'])
+
+    await async_http.gather_bounded(count, repos)
+    return estimate(counted['subtotal'], counted['covered'], len(repos))
+
+
+class FetchProgress:
+    '''Collects the fields of a profile as a crawl produces them.
+
+    The github and bitbucket get_profile functions report finished fields
+    with record and per repo totals with record_repo while they run, so a
+    caller that can't wait for the whole crawl can build a partial profile
+    from whatever has been reported so far.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fields = {}
+        # field -> (repos covered, repos total, sum over covered repos)
+        self._repo_fields = {}
+        self._finished = threading.Event()
+        self.result = None
+        self.error = None
+
+    def record(self, **fields):
+        '''Record fields whose final value is known.'''
+        with self._lock:
+            self._fields.update(fields)
+
+    def record_repo(self, field, covered, total, subtotal):
+        '''Record the running total of a field that is summed over repos.'''
+        with self._lock:
+            self._repo_fields[field] = (covered, total, subtotal)
+
+    def finish(self, result=None, error=None):
+        '''Mark the crawl as done, waking up everyone waiting on it.'''
+        with self._lock:
+            self.result = result
+            self.error = error
+        self._finished.set()
+
+    def wait(self, timeout):
+        '''Wait up to timeout seconds for the crawl. Returns True if it finished in time.'''
+        return self._finished.wait(timeout)
+
+    def estimated_fields(self):
+        '''Return the partial markers of the fields summed over repos that didn't cover every repo.'''
+        with self._lock:
+            repo_fields = dict(self._repo_fields)
+        return {
+            field: {'status': 'estimated', 'repos_covered': covered, 'repos_total': total}
+            for field, (covered, total, _) in repo_fields.items()
+            if covered < total
+        }
+
+    def partial_profile(self, count_fields):
+        '''Return (profile, partial) built from the fields reported so far.
+
+        Fields summed over repos that are only partly covered are scaled up
+        to all repos and marked 'estimated'; fields that haven't been
+        reported at all are zero/empty and marked 'missing'.
+        '''
+        with self._lock:
+            fields = dict(self._fields)
+            repo_fields = dict(self._repo_fields)
+
+        profile = {field: 0 for field in count_fields}
+        profile['languages'] = set()
+        profile['repo_topics'] = set()
+        partial = {}
+
+        for field in profile:
+            if field in fields:
+                profile[field] = fields[field]
+            elif field in repo_fields:
+                covered, total, subtotal = repo_fields[field]
+                profile[field] = estimate(subtotal, covered, total)
+                partial[field] = {'status': 'estimated', 'repos_covered': covered, 'repos_total': total}
+            else:
+                partial[field] = {'status': 'missing'}
+
+        # final totals reported with record can still be estimates
+        for field, marker in self.estimated_fields().items():
+            partial.setdefault(field, marker)
+
+        profile['language_count'] = len(profile['languages'])
+        profile['repo_topics_count'] = len(profile['repo_topics'])
+        return profile, partial
@@ -0,0 +1,96 @@
+'''Post recorded github/bitbucket webhook payloads to a running API.
+
+The recording has one JSON object per line with the provider, the event name
+(the X-GitHub-Event / X-Event-Key header) and the payload; blank lines and
+lines starting with # are ignored:
+
+    {"provider": "github", "event": "star", "payload": {"action": "created", ...}}
+
+Payloads are signed the way github/bitbucket sign them when
+GITHUB_WEBHOOK_SECRET / BITBUCKET_WEBHOOK_SECRET is set, so the API can be
+run with the same secrets. Without them the API only accepts the deliveries
+when it runs with HDUB_ALLOW_UNSIGNED_WEBHOOKS=1.
+
+    python replay_webhooks.py recorded.jsonl --url http://localhost:5000
+'''
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+
+import requests
+
+EVENT_HEADERS = {
+    'github': 'X-GitHub-Event',
+    'bitbucket': 'X-Event-Key',
+}
+SIGNATURE_HEADERS = {
+    'github': 'X-Hub-Signature-256',
+    'bitbucket': 'X-Hub-Signature',
+}
+
+
+def read_recording(lines):
+    '''Yield (provider, event, payload) for each recorded delivery.'''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        delivery = json.loads(line)
+        if delivery['provider'] not in EVENT_HEADERS:
+            raise ValueError(f'unknown provider {delivery["provider"]}')
+        yield delivery['provider'], delivery['event'], delivery['payload']
+
+
+def build_request(provider, event, payload, secret=None):
+    '''Return (path, headers, body) for posting a delivery.'''
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': 'application/json', EVENT_HEADERS[provider]: event}
+    if secret:
+        digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        headers[SIGNATURE_HEADERS[provider]] = f'sha256={digest}'
+    return f'/webhooks/{provider}', headers, body
+
+
+def replay(deliveries, post, secrets):
+    '''Post each delivery with post(path, headers, body) and return the status codes.'''
+    statuses = []
+    for provider, event, payload in deliveries:
+        path, headers, body = build_request(provider, event, payload, secrets.get(provider))
+        status_code, message = post(path, headers, body)
+        print(f'{provider} {event}: {status_code} {message}')
+        statuses.append(status_code)
+    return statuses
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Post recorded webhook payloads to the API.')
+    parser.add_argument('recording', help='file with one JSON delivery per line')
+    parser.add_argument('--url', default='http://localhost:5000', help='base url of the API')
+    args = parser.parse_args(argv)
+
+    secrets = {
+        'github': os.environ.get('GITHUB_WEBHOOK_SECRET'),
+        'bitbucket': os.environ.get('BITBUCKET_WEBHOOK_SECRET'),
+    }
+    session = requests.Session()
+
+    def post(path, headers, body):
+        resp = session.post(f'{args.url.rstrip("/")}{path}', headers=headers, data=body)
+        try:
+            message = resp.json().get('msg', '')
+        except ValueError:
+            message = resp.text
+        return resp.status_code, message
+
+    with open(args.recording) as recording:
+        statuses = replay(read_recording(recording), post, secrets)
+    failed = sum(1 for status_code in statuses if status_code >= 400)
+    print(f'replayed {len(statuses)} deliveries, {failed} failed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,61 @@
+import json
+
+import db
+
+# orjson is noticeably faster than the stdlib for large profiles, but it's
+# optional so the API still runs with only the packages in requirements.txt
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# encoded profile bodies keyed by (provider, profile name), stored together
+# with the profile dict they were encoded from. Refreshing a profile replaces
+# its dict in db, which is enough to invalidate the entry.
+PROFILE_CACHE = {}
+
+
+def _default(obj):
+    '''Encode the sets used for languages/topics as sorted lists.'''
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(obj):
+        '''Serialize obj to JSON bytes with sorted keys.'''
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SORT_KEYS)
+else:
+    def dumps(obj):
+        '''Serialize obj to JSON bytes with sorted keys.'''
+        return json.dumps(obj, default=_default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def encode_profile(provider, name, profile):
+    '''Return the encoded body for a single provider profile, caching it.'''
+    cached = PROFILE_CACHE.get((provider, name))
+    if cached is not None and cached[0] is profile:
+        return cached[1]
+    body = dumps(profile)
+    PROFILE_CACHE[(provider, name)] = (profile, body)
+    return body
+
+
+def encode_user(username):
+    '''Return the encoded merged profile body for an existing username.
+
+    A user with a single attached profile has a merged body that is identical
+    to that profile, so its pre-encoded bytes are reused as is.
+    '''
+    attached = [
+        ('bitbucket', name, db.BITBUCKET_PROFILES[name]) for name in db.USERS[username]['bitbucket']
+    ] + [
+        ('github', name, db.GITHUB_PROFILES[name]) for name in db.USERS[username]['github']
+    ]
+    # partial profiles need the partial marker that db.user.get adds
+    if len(attached) == 1 and attached[0][:2] not in db.PARTIAL_PROFILES:
+        return encode_profile(*attached[0])
+
+    merged_profile, _ = db.user.get(username)
+    return dumps(merged_profile)
@@ -0,0 +1,199 @@
+'''Snapshots of the in-memory store so a restarted process doesn't need to re-crawl.
+
+A snapshot file is laid out as:
+
+    MAGIC | profile 0 | profile 1 | ... | core | core offset (8 bytes)
+
+Every profile is pickled on its own. The core section is a pickle of the
+(offset, length) of every profile and the pickled state: users, indexes,
+versions, fetch times, partial profile markers and bitbucket commit cursors. Loading memory-maps the file and only
+unpickles the core, profiles are decoded the first time they are accessed.
+Snapshots are only ever read back by this module, so pickle is fine here.
+
+The state and the list of profiles are captured together under
+db.STORE_LOCK, so a profile attached while a snapshot is being written is
+either in both or in neither.
+'''
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+from collections.abc import MutableMapping
+
+import bitbucket
+import db
+
+MAGIC = b'HDUBSNP2'
+_OFFSET = struct.Struct('<Q')
+
+logger = logging.getLogger(__name__)
+
+
+class LazyProfiles(MutableMapping):
+    '''Profile mapping that decodes profiles from a snapshot buffer on first access.'''
+
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer
+        self._offsets = dict(offsets)
+        self._loaded = {}
+        # a profile moves from _offsets to _loaded under the lock, so other
+        # threads never see it in neither
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            try:
+                return self._loaded[name]
+            except KeyError:
+                pass
+            offset, length = self._offsets[name]
+            profile = pickle.loads(self._buffer[offset:offset + length])
+            self._loaded[name] = profile
+            del self._offsets[name]
+            return profile
+
+    def __setitem__(self, name, profile):
+        with self._lock:
+            self._loaded[name] = profile
+            self._offsets.pop(name, None)
+
+    def __delitem__(self, name):
+        with self._lock:
+            if name in self._offsets:
+                del self._offsets[name]
+            else:
+                del self._loaded[name]
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._loaded or name in self._offsets
+
+    def __iter__(self):
+        with self._lock:
+            names = list(self._loaded) + list(self._offsets)
+        yield from names
+
+    def __len__(self):
+        with self._lock:
+            return len(self._loaded) + len(self._offsets)
+
+    @property
+    def loaded_count(self):
+        '''Number of profiles that have been decoded so far.'''
+        return len(self._loaded)
+
+    def encoded_or_loaded(self, name):
+        '''Return the pickled bytes of a profile that hasn't been decoded yet, otherwise the profile.'''
+        with self._lock:
+            try:
+                offset, length = self._offsets[name]
+            except KeyError:
+                return self._loaded[name]
+            return self._buffer[offset:offset + length]
+
+
+def _capture_profiles(profiles):
+    '''Return (name, profile or its pickled bytes) for every profile, without decoding any.'''
+    if isinstance(profiles, LazyProfiles):
+        return [(name, profiles.encoded_or_loaded(name)) for name in profiles]
+    return list(profiles.items())
+
+
+def _encode_profile(profile):
+    # profiles are replaced rather than changed in place, so a captured
+    # profile can be pickled after the lock is released
+    if isinstance(profile, bytes):
+        return profile
+    return pickle.dumps(profile, pickle.HIGHEST_PROTOCOL)
+
+
+def save(path):
+    '''Atomically write a snapshot of the store to path and return its size in bytes.'''
+    with db.STORE_LOCK:
+        state = pickle.dumps({
+            'users': db.USERS,
+            'leaderboards': db.LEADERBOARDS,
+            'language_index': db.LANGUAGE_INDEX,
+            'topic_index': db.TOPIC_INDEX,
+            'user_versions': db.USER_VERSIONS,
+            'fetched_at': db.FETCHED_AT,
+            'partial_profiles': db.PARTIAL_PROFILES,
+            # cursors are moved by crawls, which don't take the lock
+            'commit_cursors': dict(bitbucket.COMMIT_CURSORS),
+        }, pickle.HIGHEST_PROTOCOL)
+        captured = {
+            'bitbucket': _capture_profiles(db.BITBUCKET_PROFILES),
+            'github': _capture_profiles(db.GITHUB_PROFILES),
+        }
+
+    # write next to the destination so the final rename stays on one filesystem
+    tmp_path = f'{path}.tmp'
+    offsets = {'bitbucket': {}, 'github': {}}
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(MAGIC)
+        position = len(MAGIC)
+        for provider, profiles in captured.items():
+            for name, profile in profiles:
+                encoded = _encode_profile(profile)
+                snapshot_file.write(encoded)
+                offsets[provider][name] = (position, len(encoded))
+                position += len(encoded)
+
+        core = pickle.dumps({'state': state, 'profiles': offsets}, pickle.HIGHEST_PROTOCOL)
+        snapshot_file.write(core)
+        snapshot_file.write(_OFFSET.pack(position))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+        size = position + len(core) + _OFFSET.size
+    os.replace(tmp_path, path)
+    return size
+
+
+def load(path):
+    '''Restore the store from a snapshot written by save.'''
+    with open(path, 'rb') as snapshot_file:
+        buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        buffer.close()
+        raise ValueError(f'{path} is not a snapshot file')
+
+    core_offset, = _OFFSET.unpack(buffer[-_OFFSET.size:])
+    core = pickle.loads(buffer[core_offset:-_OFFSET.size])
+    state = pickle.loads(core['state'])
+
+    db.USERS = state['users']
+    db.LEADERBOARDS = state['leaderboards']
+    db.LANGUAGE_INDEX = state['language_index']
+    db.TOPIC_INDEX = state['topic_index']
+    db.USER_VERSIONS = state['user_versions']
+    for version in db.USER_VERSIONS.values():
+        # versions saved before they had an epoch get a new ETag
+        version.setdefault('epoch', db.EPOCH)
+    db.FETCHED_AT = state['fetched_at']
+    db.PARTIAL_PROFILES = state['partial_profiles']
+    bitbucket.COMMIT_CURSORS = state['commit_cursors']
+    db.BITBUCKET_PROFILES = LazyProfiles(buffer, core['profiles']['bitbucket'])
+    db.GITHUB_PROFILES = LazyProfiles(buffer, core['profiles']['github'])
+    db.restore_version_counter()
+
+
+def start_periodic(path, interval):
+    '''Save a snapshot to path every interval seconds from a daemon thread.
+
+    A failed save is logged and retried at the next interval. Returns an
+    Event that stops the thread when set.
+    '''
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                save(path)
+            except Exception:
+                logger.exception('saving a snapshot to %s failed', path)
+
+    threading.Thread(target=run, name='snapshot', daemon=True).start()
+    return stopped
@@ -1,10 +1,74 @@
 import github
 import bitbucket
 import db
+import indexes
+import main
+import serializer
+import prefetch
+import progress
+import replay_webhooks
+import snapshot
+import upstream
+import webhooks
 
-from unittest.mock import Mock, patch
+import asyncio
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+from contextlib import redirect_stdout
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, Mock, patch
 import unittest
 
+import async_http
+import columnar
+import loadtest
+
+try:
+    import async_main
+except ImportError:
+    # quart/aiohttp are only needed for the async serving mode
+    async_main = None
+
+try:
+    import hypercorn
+except ImportError:
+    # only needed to load test the async serving mode
+    hypercorn = None
+
+
+def make_profile(**counts):
+    '''Build a well formed profile with zeroed counts, overridden by counts.'''
+    profile = {field: 0 for field in db.COUNT_FIELDS}
+    profile.update({
+        'languages': set(),
+        'language_count': 0,
+        'repo_topics': set(),
+        'repo_topics_count': 0,
+    })
+    profile.update(counts)
+    return profile
+
+
+def reset_db():
+    db.USERS = {}
+    db.BITBUCKET_PROFILES = {}
+    db.GITHUB_PROFILES = {}
+    db.LEADERBOARDS = {metric: indexes.SortedIndex() for metric in db.COUNT_FIELDS}
+    db.LANGUAGE_INDEX = indexes.InvertedIndex()
+    db.TOPIC_INDEX = indexes.InvertedIndex()
+    db.USER_VERSIONS = {}
+    db.FETCHED_AT = {'bitbucket': {}, 'github': {}}
+    db.PARTIAL_PROFILES = {}
+    db._CRAWLS = {}
+    bitbucket.COMMIT_CURSORS = {}
+    main.USER_RESPONSE_CACHE = {}
+    serializer.PROFILE_CACHE = {}
+
 
 class GithubAPITest(unittest.TestCase):
     @patch('github.get_repos')
@@ -136,6 +200,24 @@ class GithubAPITest(unittest.TestCase):
             'parse_count_from_response with no links should return len of value returned from json() call'
         )
 
+    @patch('async_http.get')
+    def test_get_commit_count_async(self, get):
+        def response(session, url, headers, timeout=None):
+            pages = {'first': 3, 'second': 5}
+            repo = url.split('/')[-2]
+            links = {'last': {'url': f'https://api.github.com/?page={pages[repo]}'}}
+            return async_http.AsyncResponse(200, links, [])
+        get.side_effect = response
+
+        repos = [
+            {'name': 'first', 'fork': False},
+            {'name': 'second', 'fork': False},
+            {'name': 'forked', 'fork': True},
+        ]
+        count = asyncio.run(github.get_commit_count_async('david', repos, session=None))
+        self.assertEqual(count, 8)
+        self.assertEqual(get.call_count, 2)
+
 
 class BitbucketAPITest(unittest.TestCase):
     @patch('bitbucket.get_repos')
@@ -244,17 +326,62 @@ class BitbucketAPITest(unittest.TestCase):
             expected
         )
 
+    @patch('bitbucket._get_repo_watcher_count')
+    def test_get_watcher_count_skips_failing_repos(self, get_repo_watcher_count):
+        get_repo_watcher_count.side_effect = [
+            2,
+            bitbucket.BitbucketAPIException('bitbucket.watchers is failing, not calling it until it recovers.'),
+            4,
+        ]
+        fetch_progress = progress.FetchProgress()
+        count = bitbucket.get_watcher_count('david', [{'slug': 'a'}, {'slug': 'b'}, {'slug': 'c'}], fetch_progress)
+        # scaled up from the two repos that were counted
+        self.assertEqual(count, 9)
+        self.assertEqual(
+            fetch_progress.estimated_fields(),
+            {'watcher_count': {'status': 'estimated', 'repos_covered': 2, 'repos_total': 3}}
+        )
+
+    @patch('bitbucket._get')
+    def test_get_repo_commit_count_resumes_from_cursor(self, get):
+        def commit_pages(hashes, page_size=2):
+            pages = []
+            for start in range(0, len(hashes), page_size):
+                page = {'values': [{'hash': commit_hash} for commit_hash in hashes[start:start + page_size]]}
+                if start + page_size < len(hashes):
+                    page['next'] = f'https://api.bitbucket.org/page{len(pages) + 2}'
+                pages.append(Mock(ok=True, json=Mock(return_value=page)))
+            return pages
+
+        self.addCleanup(setattr, bitbucket, 'COMMIT_CURSORS', {})
+        bitbucket.COMMIT_CURSORS = {}
+        repo = {'slug': 'repo'}
+
+        get.side_effect = commit_pages(['e', 'd', 'c', 'b', 'a'])
+        self.assertEqual(bitbucket._get_repo_commit_count('david', repo), 5)
+        self.assertEqual(bitbucket.COMMIT_CURSORS[('david', 'repo')], {'hash': 'e', 'count': 5})
+
+        # two new commits: only the first page is needed
+        get.reset_mock()
+        get.side_effect = commit_pages(['g', 'f', 'e', 'd', 'c', 'b', 'a'], page_size=3)
+        self.assertEqual(bitbucket._get_repo_commit_count('david', repo), 7)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(bitbucket.COMMIT_CURSORS[('david', 'repo')], {'hash': 'g', 'count': 7})
+
+        # history was rewritten so the cursor is never found: full recount
+        get.reset_mock()
+        get.side_effect = commit_pages(["x", "b'", "a"])
+        self.assertEqual(bitbucket._get_repo_commit_count('david', repo), 3)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(bitbucket.COMMIT_CURSORS[('david', 'repo')], {'hash': 'x', 'count': 3})
+
 
 class DBTest(unittest.TestCase):
     def setUp(self):
-        db.USERS = {}
-        db.BITBUCKET_PROFILES = {}
-        db.GITHUB_PROFILES = {}
+        reset_db()
 
     def tearDown(self):
-        db.USERS = {}
-        db.BITBUCKET_PROFILES = {}
-        db.GITHUB_PROFILES = {}
+        reset_db()
 
     def test_user_create(self):
         response, status_code = db.user.create('david')
@@ -347,10 +474,7 @@ class DBTest(unittest.TestCase):
 
     @patch('db.get_bitbucket_profile')
     def test_bitbucket_add(self, get_bitbucket_profile):
-        # obviously there isn't a guarantee that what you put into the
-        # 'database' is going to be well formed... this breaks everything
-        # fine for test stubs though
-        get_bitbucket_profile.return_value = 'this_is_a_user_profile'
+        get_bitbucket_profile.return_value = make_profile()
         db.user.create('david')
         db.user.create('chester')
         response, status = db.bitbucket.add('david', 'coolranchdoritos')
@@ -371,7 +495,7 @@ class DBTest(unittest.TestCase):
 
     @patch('db.get_bitbucket_profile')
     def test_bitbucket_delete(self, get_bitbucket_profile):
-        get_bitbucket_profile.return_value = 'this_is_a_user_profile'
+        get_bitbucket_profile.return_value = make_profile()
         db.user.create('david')
         db.bitbucket.add('david', 'coolranchdoritos')
 
@@ -393,7 +517,7 @@ class DBTest(unittest.TestCase):
 
     @patch('db.get_github_profile')
     def test_add_github_profile(self, get_github_profile):
-        get_github_profile.return_value = 'this_is_a_user_profile'
+        get_github_profile.return_value = make_profile()
         db.user.create('david')
         db.user.create('chester')
         response, status = db.github.add('david', 'coolranchdoritos')
@@ -414,7 +538,7 @@ class DBTest(unittest.TestCase):
 
     @patch('db.get_github_profile')
     def test_delete_github_profile(self, get_github_profile):
-        get_github_profile.return_value = 'this_is_a_user_profile'
+        get_github_profile.return_value = make_profile()
         db.user.create('david')
         db.github.add('david', 'coolranchdoritos')
 
@@ -434,6 +558,1177 @@ class DBTest(unittest.TestCase):
         self.assertEqual(response, {'msg': 'user cheetos not found'})
         self.assertEqual(status, 404)
 
+    @patch('db.get_github_profile')
+    def test_refresh_github_profile(self, get_github_profile):
+        get_github_profile.return_value = make_profile(stars_received=5)
+        db.user.create('david')
+        db.github.add('david', 'coolranchdoritos')
+
+        get_github_profile.return_value = make_profile(stars_received=8)
+        response, status = db.github.refresh('david', 'coolranchdoritos')
+        self.assertEqual(response, {'msg': 'refreshed github profile coolranchdoritos for david'})
+        self.assertEqual(status, 200)
+        self.assertEqual(db.user.get('david')[0]['stars_received'], 8)
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score('david'), 8)
+
+        response, status = db.github.refresh('david', 'doesntexist')
+        self.assertEqual(response, {'msg': 'doesntexist not attached to user david'})
+        self.assertEqual(status, 404)
+
+    @patch('db.get_bitbucket_profile')
+    @patch('db.get_github_profile')
+    def test_leaderboard(self, get_github_profile, get_bitbucket_profile):
+        get_github_profile.side_effect = lambda profile, progress=None: {
+            'gh_big': make_profile(stars_received=50, follower_count=1),
+            'gh_small': make_profile(stars_received=5, follower_count=10),
+        }[profile]
+        get_bitbucket_profile.return_value = make_profile(follower_count=20)
+
+        db.user.create('david')
+        db.user.create('chester')
+        db.user.create('lindsey')
+        db.github.add('david', 'gh_small')
+        db.bitbucket.add('david', 'bb')
+        db.github.add('chester', 'gh_big')
+
+        response, status = db.leaderboard.get('stars_received', limit=2)
+        self.assertEqual(status, 200)
+        self.assertEqual(response, {
+            'metric': 'stars_received',
+            'leaders': [
+                {'rank': 1, 'username': 'chester', 'value': 50},
+                {'rank': 2, 'username': 'david', 'value': 5},
+            ]
+        })
+
+        response, status = db.leaderboard.get('follower_count', username='chester')
+        self.assertEqual(
+            [leader['username'] for leader in response['leaders']],
+            ['david', 'chester', 'lindsey']
+        )
+        self.assertEqual(response['user'], {'rank': 2, 'username': 'chester', 'value': 1})
+
+        # detaching and deleting should be reflected without a rebuild
+        db.bitbucket.delete('david', 'bb')
+        db.user.delete('chester')
+        response, status = db.leaderboard.get('follower_count')
+        self.assertEqual(response['leaders'], [
+            {'rank': 1, 'username': 'david', 'value': 10},
+            {'rank': 2, 'username': 'lindsey', 'value': 0},
+        ])
+
+        response, status = db.leaderboard.get('not_a_metric')
+        self.assertEqual(status, 400)
+        response, status = db.leaderboard.get('stars_received', limit=0)
+        self.assertEqual(status, 400)
+        response, status = db.leaderboard.get('stars_received', username='cheetos')
+        self.assertEqual(response, {'msg': 'user cheetos not found'})
+        self.assertEqual(status, 404)
+
+    @patch('db.get_bitbucket_profile')
+    @patch('db.get_github_profile')
+    def test_search(self, get_github_profile, get_bitbucket_profile):
+        get_github_profile.side_effect = lambda profile, progress=None: {
+            'gh_david': make_profile(languages={'rust', 'python'}, repo_topics={'cli'}),
+            'gh_chester': make_profile(languages={'python'}, repo_topics={'web'}),
+        }[profile]
+        get_bitbucket_profile.return_value = make_profile(languages={'python', 'go'})
+
+        db.user.create('david')
+        db.user.create('chester')
+        db.github.add('david', 'gh_david')
+        db.bitbucket.add('david', 'bb_david')
+        db.github.add('chester', 'gh_chester')
+
+        response, status = db.search.get(languages=['Python'])
+        self.assertEqual(status, 200)
+        self.assertEqual(response, {'users': ['chester', 'david'], 'total': 2, 'limit': 20, 'offset': 0})
+
+        response, status = db.search.get(languages=['python'], topics=['cli'])
+        self.assertEqual(response['users'], ['david'])
+
+        response, status = db.search.get(topics=['cli', 'web'], mode='or', limit=1, offset=1)
+        self.assertEqual(response, {'users': ['david'], 'total': 2, 'limit': 1, 'offset': 1})
+
+        # python is still provided by the bitbucket profile after detaching github
+        db.github.delete('david', 'gh_david')
+        response, status = db.search.get(languages=['python'])
+        self.assertEqual(response['users'], ['chester', 'david'])
+        response, status = db.search.get(languages=['rust'])
+        self.assertEqual(response['users'], [])
+
+        db.user.delete('david')
+        response, status = db.search.get(languages=['python', 'go'], mode='or')
+        self.assertEqual(response['users'], ['chester'])
+
+        response, status = db.search.get()
+        self.assertEqual(status, 400)
+        response, status = db.search.get(languages=['python'], mode='xor')
+        self.assertEqual(status, 400)
+
+    @patch('db.get_github_profile')
+    def test_add_with_budget(self, get_github_profile):
+        release_crawl = threading.Event()
+
+        def slow_crawl(profile, progress):
+            progress.record(public_source_repositories=4, stars_received=10, languages={'go'})
+            progress.record_repo('total_source_commit_count', 1, 4, 25)
+            release_crawl.wait(5)
+            progress.record_repo('total_source_commit_count', 4, 4, 90)
+            return make_profile(
+                public_source_repositories=4, stars_received=10, total_source_commit_count=90,
+                follower_count=3, languages={'go'}, language_count=1
+            )
+        get_github_profile.side_effect = slow_crawl
+        db.user.create('david')
+
+        started = time.monotonic()
+        response, status = db.github.add('david', 'coolranchdoritos', budget=0.05)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(status, 201)
+        self.assertEqual(response['msg'], 'added github profile coolranchdoritos to david')
+        fields = response['partial']['fields']
+        self.assertEqual(
+            fields['total_source_commit_count'],
+            {'status': 'estimated', 'repos_covered': 1, 'repos_total': 4}
+        )
+        self.assertEqual(fields['follower_count'], {'status': 'missing'})
+        self.assertNotIn('stars_received', fields)
+
+        merged, _ = db.user.get('david')
+        self.assertEqual(merged['total_source_commit_count'], 100)
+        self.assertEqual(merged['stars_received'], 10)
+        self.assertEqual(merged['languages'], ['go'])
+        self.assertIn('github/coolranchdoritos', merged['partial'])
+        self.assertFalse(db.is_fresh('github', 'coolranchdoritos', 60))
+
+        # the crawl finishes in the background and replaces the partial profile
+        release_crawl.set()
+        deadline = time.monotonic() + 5
+        while db.PARTIAL_PROFILES and time.monotonic() < deadline:
+            time.sleep(0.01)
+        merged, _ = db.user.get('david')
+        self.assertNotIn('partial', merged)
+        self.assertEqual(merged['total_source_commit_count'], 90)
+        self.assertEqual(db.LEADERBOARDS['follower_count'].score('david'), 3)
+        self.assertTrue(db.is_fresh('github', 'coolranchdoritos', 60))
+
+    @patch('db.get_github_profile')
+    def test_concurrent_adds_share_one_crawl(self, get_github_profile):
+        both_started = threading.Barrier(2)
+        release_crawl = threading.Event()
+
+        def slow_crawl(profile, progress):
+            release_crawl.wait(5)
+            return make_profile(stars_received=get_github_profile.call_count * 100, repo_topics={'cli'})
+        get_github_profile.side_effect = slow_crawl
+        db.user.create('a')
+        db.user.create('b')
+
+        statuses = {}
+
+        def add(username):
+            both_started.wait(5)
+            statuses[username] = db.github.add(username, 'x')[1]
+        threads = [threading.Thread(target=add, args=(username,)) for username in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release_crawl.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(get_github_profile.call_count, 1)
+        self.assertEqual(sorted(statuses.values()), [201, 409])
+        owner = 'a' if statuses['a'] == 201 else 'b'
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score(owner), 100)
+        self.assertEqual(db.github.delete(owner, 'x')[1], 200)
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score(owner), 0)
+
+    @patch('db.get_github_profile')
+    def test_add_with_budget_failing_after_refresh(self, get_github_profile):
+        release_crawl = threading.Event()
+        crawl_failed = threading.Event()
+
+        def failing_crawl(profile, progress):
+            release_crawl.wait(5)
+            crawl_failed.set()
+            raise github.GithubAPIException('boom')
+        get_github_profile.side_effect = failing_crawl
+        db.user.create('david')
+        db.github.add('david', 'coolranchdoritos', budget=0.01)
+
+        # a refresh completes the profile before the background crawl fails
+        db.update_profile('github', 'coolranchdoritos', make_profile(stars_received=3))
+        with patch('threading.excepthook') as excepthook:
+            release_crawl.set()
+            crawl_failed.wait(5)
+            time.sleep(0.05)
+        excepthook.assert_not_called()
+        self.assertNotIn(('github', 'coolranchdoritos'), db.PARTIAL_PROFILES)
+        self.assertEqual(db.user.get('david')[0]['stars_received'], 3)
+
+    @patch('db.get_github_profile')
+    def test_add_with_budget_finishing_in_time(self, get_github_profile):
+        get_github_profile.return_value = make_profile(stars_received=2)
+        db.user.create('david')
+        response, status = db.github.add('david', 'coolranchdoritos', budget=5)
+        self.assertEqual(response, {'msg': 'added github profile coolranchdoritos to david'})
+        self.assertEqual(db.user.get('david')[0]['stars_received'], 2)
+
+    @patch('db.get_github_profile')
+    def test_add_with_failed_repos(self, get_github_profile):
+        def crawl(profile, progress):
+            progress.record_repo('total_source_commit_count', 2, 3, 30)
+            return make_profile(total_source_commit_count=45)
+        get_github_profile.side_effect = crawl
+        db.user.create('david')
+
+        response, status = db.github.add('david', 'coolranchdoritos')
+        self.assertEqual(status, 201)
+        marker = {'status': 'estimated', 'repos_covered': 2, 'repos_total': 3}
+        self.assertEqual(response['partial'], {'fields': {'total_source_commit_count': marker}})
+        self.assertIn('github/coolranchdoritos', db.user.get('david')[0]['partial'])
+
+        # a refresh that covers every repo clears the marker
+        get_github_profile.side_effect = None
+        get_github_profile.return_value = make_profile(total_source_commit_count=50)
+        db.github.refresh('david', 'coolranchdoritos')
+        self.assertNotIn('partial', db.user.get('david')[0])
+        self.assertEqual(db.LEADERBOARDS['total_source_commit_count'].score('david'), 50)
+
+    @patch('db.get_github_profile_async')
+    def test_add_async_with_budget(self, get_github_profile_async):
+        async def slow_crawl(profile, session, progress):
+            progress.record(stars_received=10)
+            progress.record_repo('total_source_commit_count', 1, 2, 5)
+            await release_crawl.wait()
+            progress.record_repo('total_source_commit_count', 2, 2, 12)
+            return make_profile(stars_received=10, total_source_commit_count=12)
+        get_github_profile_async.side_effect = slow_crawl
+        release_crawl = asyncio.Event()
+        db.user.create('david')
+
+        async def attach():
+            response, status = await db.github.add_async('david', 'coolranchdoritos', None, budget=0.01)
+            self.assertEqual(status, 201)
+            self.assertEqual(response['partial']['fields']['follower_count'], {'status': 'missing'})
+            self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 10)
+
+            task, _ = db._ASYNC_CRAWLS[('github', 'coolranchdoritos')]
+            release_crawl.set()
+            await task
+        asyncio.run(attach())
+
+        merged, _ = db.user.get('david')
+        self.assertNotIn('partial', merged)
+        self.assertEqual(merged['total_source_commit_count'], 12)
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score('david'), 10)
+
+    @patch('db.get_github_profile_async')
+    def test_concurrent_add_async_shares_the_crawl(self, get_github_profile_async):
+        crawls = []
+
+        async def crawl(profile, session, progress=None):
+            crawls.append(profile)
+            await asyncio.sleep(0.01)
+            return make_profile(stars_received=10 * len(crawls))
+        get_github_profile_async.side_effect = crawl
+        db.user.create('a')
+        db.user.create('b')
+
+        async def attach_twice():
+            return await asyncio.gather(
+                db.github.add_async('a', 'coolranchdoritos', None),
+                db.github.add_async('b', 'coolranchdoritos', None),
+            )
+        (_, first_status), (_, second_status) = asyncio.run(attach_twice())
+        self.assertEqual((first_status, second_status), (201, 409))
+        self.assertEqual(crawls, ['coolranchdoritos'])
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score('a'), 10)
+
+        db.github.delete('a', 'coolranchdoritos')
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score('a'), 0)
+
+
+class UserRouteTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        reset_db()
+
+    @patch('db.get_github_profile')
+    def test_conditional_get(self, get_github_profile):
+        get_github_profile.return_value = make_profile(stars_received=3)
+        self.client.post('/user/david')
+
+        response = self.client.get('/user/david')
+        self.assertEqual(response.status_code, 200)
+        etag, _ = response.get_etag()
+        self.assertIsNotNone(response.last_modified)
+
+        with patch('db.user.get') as get_user:
+            response = self.client.get('/user/david', headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+            get_user.assert_not_called()
+
+            # a changed etag with the same version is served from the cache
+            response = self.client.get('/user/david', headers={'If-None-Match': '"stale"'})
+            self.assertEqual(response.status_code, 200)
+            get_user.assert_not_called()
+
+        self.client.post('/user/david/github/coolranchdoritos')
+        response = self.client.get('/user/david', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        self.assertEqual(response.get_json()['stars_received'], 3)
+
+        response = self.client.get('/user/doesnotexist')
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(response.get_etag()[0])
+
+    def test_etag_after_restart(self):
+        self.client.post('/user/alice')
+        etag, _ = self.client.get('/user/alice').get_etag()
+
+        # a new process starts counting versions from 1 again
+        reset_db()
+        with patch('db.EPOCH', 'restarted'), patch('db._version_counter', itertools.count(1)):
+            self.client.post('/user/alice')
+            self.assertEqual(db.user.version('alice')['version'], 1)
+            response = self.client.get('/user/alice', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_etag()[0], 'restarted-1')
+
+    def test_etag_for_any_username(self):
+        self.client.post('/user/a%22b')
+        response = self.client.get('/user/a%22b')
+        self.assertEqual(response.status_code, 200)
+        etag, _ = response.get_etag()
+        response = self.client.get('/user/a%22b', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+
+    @patch('db.get_github_profile')
+    def test_if_modified_since_within_a_second(self, get_github_profile):
+        get_github_profile.return_value = make_profile(stars_received=3)
+        now = datetime(2020, 1, 1, 12, 0, 0, 100, tzinfo=timezone.utc)
+        with patch('db.datetime') as db_datetime:
+            db_datetime.now.return_value = now
+            self.client.post('/user/david')
+            last_modified = self.client.get('/user/david').headers['Last-Modified']
+
+            # attached in the same second as the GET above
+            self.client.post('/user/david/github/coolranchdoritos')
+            response = self.client.get('/user/david', headers={'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['stars_received'], 3)
+
+            # once a change is alone in its second the header is trusted again
+            db_datetime.now.return_value = now + timedelta(seconds=5)
+            self.client.delete('/user/david/github/coolranchdoritos')
+            last_modified = self.client.get('/user/david').headers['Last-Modified']
+            response = self.client.get('/user/david', headers={'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 304)
+
+
+@unittest.skipIf(async_main is None, 'quart is not installed')
+class AsyncRouteTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.client = async_main.app.test_client()
+
+    def tearDown(self):
+        reset_db()
+
+    @patch('db.get_github_profile_async', new_callable=AsyncMock)
+    def test_routes_match_sync_app(self, get_github_profile_async):
+        get_github_profile_async.return_value = make_profile(stars_received=3)
+
+        async def exercise():
+            response = await self.client.post('/user/david')
+            self.assertEqual(response.status_code, 201)
+
+            response = await self.client.post('/user/david/github/coolranchdoritos')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(await response.get_json(), {'msg': 'added github profile coolranchdoritos to david'})
+
+            response = await self.client.post('/user/cheetos/github/coolranchdoritos')
+            self.assertEqual(response.status_code, 404)
+
+            response = await self.client.get('/user/david')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual((await response.get_json())['stars_received'], 3)
+
+            response = await self.client.get('/user/david', headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+
+            response = await self.client.delete('/user/david/github/coolranchdoritos')
+            self.assertEqual(response.status_code, 200)
+
+        asyncio.run(exercise())
+        get_github_profile_async.assert_awaited_once()
+
+
+class SerializerTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+
+    def tearDown(self):
+        reset_db()
+
+    def test_dumps_sorts_sets_and_keys(self):
+        body = serializer.dumps({'b': {'z', 'a'}, 'a': 1})
+        self.assertEqual(json.loads(body), {'a': 1, 'b': ['a', 'z']})
+        self.assertLess(body.index(b'"a"'), body.index(b'"b"'))
+
+    @patch('db.get_bitbucket_profile')
+    @patch('db.get_github_profile')
+    def test_encode_user(self, get_github_profile, get_bitbucket_profile):
+        get_github_profile.return_value = make_profile(
+            stars_received=3, languages={'python', 'go'}, language_count=2
+        )
+        get_bitbucket_profile.return_value = make_profile(
+            follower_count=2, languages={'rust'}, language_count=1
+        )
+        db.user.create('david')
+        db.github.add('david', 'coolranchdoritos')
+
+        # a single profile is served from its pre-encoded bytes
+        body = serializer.encode_user('david')
+        self.assertEqual(json.loads(body), db.user.get('david')[0])
+        self.assertIs(serializer.encode_user('david'), body)
+
+        db.bitbucket.add('david', 'coolranchdoritos')
+        self.assertEqual(json.loads(serializer.encode_user('david')), db.user.get('david')[0])
+
+        db.bitbucket.delete('david', 'coolranchdoritos')
+        get_github_profile.return_value = make_profile(stars_received=4)
+        db.github.refresh('david', 'coolranchdoritos')
+        self.assertEqual(json.loads(serializer.encode_user('david'))['stars_received'], 4)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'store.snapshot')
+
+    def tearDown(self):
+        reset_db()
+        self.tmp_dir.cleanup()
+
+    @patch('db.get_bitbucket_profile')
+    @patch('db.get_github_profile')
+    def test_save_and_load(self, get_github_profile, get_bitbucket_profile):
+        get_github_profile.return_value = make_profile(stars_received=3, languages={'rust'})
+        get_bitbucket_profile.return_value = make_profile(follower_count=2, languages={'go'})
+        db.user.create('david')
+        db.user.create('chester')
+        db.github.add('david', 'coolranchdoritos')
+        db.bitbucket.add('chester', 'cheetos')
+        expected = db.user.get('david')[0]
+        version = db.user.version('david')
+
+        snapshot.save(self.path)
+        self.assertFalse(os.path.exists(f'{self.path}.tmp'))
+        reset_db()
+        # loaded as if by a new process
+        epoch_patch = patch('db.EPOCH', 'restarted')
+        epoch_patch.start()
+        self.addCleanup(epoch_patch.stop)
+        snapshot.load(self.path)
+
+        # profiles are only decoded once something asks for them
+        self.assertEqual(db.GITHUB_PROFILES.loaded_count, 0)
+        self.assertIn('coolranchdoritos', db.GITHUB_PROFILES)
+        self.assertEqual(db.user.get('david')[0], expected)
+        self.assertEqual(db.GITHUB_PROFILES.loaded_count, 1)
+        self.assertEqual(db.BITBUCKET_PROFILES.loaded_count, 0)
+
+        self.assertEqual(db.user.version('david'), version)
+        self.assertEqual(db.search.get(languages=['go'])[0]['users'], ['chester'])
+        self.assertEqual(db.leaderboard.get('stars_received', limit=1)[0]['leaders'][0]['username'], 'david')
+
+        # new versions keep counting up from the restored ones, under the
+        # new process's epoch
+        db.user.create('lindsey')
+        self.assertGreater(db.user.version('lindsey')['version'], version['version'])
+        self.assertEqual(db.user.version('lindsey')['epoch'], 'restarted')
+
+        # profiles that were never decoded are copied over as is
+        snapshot.save(self.path)
+        reset_db()
+        snapshot.load(self.path)
+        self.assertEqual(db.BITBUCKET_PROFILES['cheetos']['follower_count'], 2)
+        self.assertIn('lindsey', db.USERS)
+
+    @patch('db.get_github_profile')
+    def test_save_while_attaching(self, get_github_profile):
+        get_github_profile.return_value = make_profile(stars_received=3)
+        db.user.create('a')
+        db.user.create('b')
+        db.github.add('a', 'p1')
+
+        encode_profile = snapshot._encode_profile
+
+        def attach_while_writing(profile):
+            # runs after the state was captured, like a request thread would
+            if 'p2' not in db.GITHUB_PROFILES:
+                db.github.add('b', 'p2')
+            return encode_profile(profile)
+
+        with patch('snapshot._encode_profile', attach_while_writing):
+            snapshot.save(self.path)
+        self.assertIn('p2', db.USERS['b']['github'])
+
+        reset_db()
+        snapshot.load(self.path)
+        self.assertEqual(db.user.get('b')[1], 200)
+        self.assertEqual(db.USERS['b']['github'], set())
+        self.assertNotIn('p2', db.GITHUB_PROFILES)
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score('b'), 0)
+
+    def test_partial_profiles_are_kept(self):
+        marker = {'total_source_commit_count': {'status': 'estimated', 'repos_covered': 1, 'repos_total': 2}}
+        db.cache_profile('github', 'coolranchdoritos', make_profile(), partial=marker)
+        snapshot.save(self.path)
+        reset_db()
+        snapshot.load(self.path)
+        self.assertEqual(db.PARTIAL_PROFILES[('github', 'coolranchdoritos')], {'fields': marker})
+        self.assertFalse(db.is_fresh('github', 'coolranchdoritos', 60))
+
+    def test_periodic_save_survives_errors(self):
+        saved = threading.Event()
+        calls = []
+
+        def save(path):
+            calls.append(path)
+            if len(calls) == 1:
+                raise RuntimeError('dictionary changed size during iteration')
+            saved.set()
+
+        with patch('snapshot.save', save), self.assertLogs('snapshot', level='ERROR'):
+            stopped = snapshot.start_periodic(self.path, 0.01)
+            self.assertTrue(saved.wait(5))
+            stopped.set()
+
+    def test_load_rejects_other_files(self):
+        with open(self.path, 'wb') as not_a_snapshot:
+            not_a_snapshot.write(b'definitely not a snapshot')
+        with self.assertRaises(ValueError):
+            snapshot.load(self.path)
+
+
+class PrefetchTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        reset_db()
+        self.tmp_dir.cleanup()
+
+    def test_read_profile_list(self):
+        path = os.path.join(self.tmp_dir.name, 'profiles.txt')
+        with open(path, 'w') as profile_list:
+            profile_list.write('# launch list\ngithub kennethreitz\n\nbitbucket,pygame\ngithub kennethreitz\n')
+        self.assertEqual(
+            prefetch.read_profile_list(path),
+            [('github', 'kennethreitz'), ('bitbucket', 'pygame')]
+        )
+
+        with open(path, 'w') as profile_list:
+            profile_list.write('gitlab someone\n')
+        with self.assertRaises(ValueError):
+            prefetch.read_profile_list(path)
+
+    @patch('db.get_bitbucket_profile')
+    @patch('db.get_github_profile')
+    def test_prefetch(self, get_github_profile, get_bitbucket_profile):
+        def github_profile(profile, progress=None):
+            if profile == 'broken':
+                raise github.GithubAPIException('Error calling repos API. Status code: 500')
+            return make_profile(stars_received=7)
+        get_github_profile.side_effect = github_profile
+        get_bitbucket_profile.return_value = make_profile(follower_count=1)
+        snapshot_path = os.path.join(self.tmp_dir.name, 'store.snapshot')
+        pairs = [('github', 'kennethreitz'), ('github', 'broken'), ('bitbucket', 'pygame')]
+
+        results = prefetch.prefetch(pairs, workers=2, rate=1000, max_age=60, snapshot_path=snapshot_path,
+                                    out=io.StringIO())
+        self.assertEqual(results, {'fetched': 2, 'failed': 1, 'skipped': 0})
+        self.assertEqual(db.GITHUB_PROFILES['kennethreitz']['stars_received'], 7)
+
+        # resuming from the snapshot only retries what's missing
+        reset_db()
+        snapshot.load(snapshot_path)
+        get_github_profile.reset_mock()
+        results = prefetch.prefetch(pairs, workers=2, rate=1000, max_age=60, out=io.StringIO())
+        self.assertEqual(results, {'fetched': 0, 'failed': 1, 'skipped': 2})
+        get_github_profile.assert_called_once()
+        self.assertEqual(get_github_profile.call_args[0], ('broken',))
+        get_bitbucket_profile.assert_called_once()
+
+        # attaching a prefetched profile doesn't call the API again
+        db.user.create('david')
+        db.github.add('david', 'kennethreitz')
+        self.assertEqual(get_github_profile.call_count, 1)
+
+        # re-fetching an attached profile keeps the indexes in sync
+        get_github_profile.side_effect = None
+        get_github_profile.return_value = make_profile(stars_received=9)
+        prefetch.prefetch([('github', 'kennethreitz')], workers=1, rate=1000, max_age=0, out=io.StringIO())
+        self.assertEqual(db.LEADERBOARDS['stars_received'].score('david'), 9)
+
+
+class UpstreamTest(unittest.TestCase):
+    def setUp(self):
+        upstream.BREAKERS.clear()
+        upstream.LATENCIES.clear()
+        upstream.RATE_LIMITERS.clear()
+
+    def tearDown(self):
+        upstream.BREAKERS.clear()
+        upstream.LATENCIES.clear()
+        upstream.RATE_LIMITERS.clear()
+
+    def test_circuit_breaker(self):
+        breaker = upstream.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        # after the reset timeout only one trial call is let through
+        breaker._opened_at -= 60
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+        breaker._opened_at = time.monotonic() - 60
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+    @patch('upstream.RETRY_BACKOFF', 0)
+    @patch('upstream.requests.get')
+    def test_get_retries(self, requests_get):
+        requests_get.side_effect = [
+            upstream.requests.ConnectionError('reset'),
+            Mock(status_code=503, headers={}),
+            Mock(status_code=200, headers={}),
+        ]
+        resp = upstream.get('https://example.com', {}, 'bitbucket.watchers', bitbucket.BitbucketAPIException)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(requests_get.call_count, 3)
+        self.assertEqual(upstream.BREAKERS['bitbucket.watchers'].state, 'closed')
+
+        # client errors are returned as is, without retrying
+        requests_get.reset_mock(side_effect=True)
+        requests_get.return_value = Mock(status_code=404, headers={})
+        resp = upstream.get('https://example.com', {}, 'bitbucket.users', bitbucket.BitbucketAPIException)
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(requests_get.call_count, 1)
+
+    @patch('upstream.RETRY_BACKOFF', 0)
+    @patch('upstream.FAILURE_THRESHOLD', 3)
+    @patch('upstream.requests.get')
+    def test_get_fails_fast_when_open(self, requests_get):
+        requests_get.side_effect = upstream.requests.Timeout('slow')
+        with self.assertRaises(bitbucket.BitbucketAPIException):
+            upstream.get('https://example.com', {}, 'bitbucket.watchers', bitbucket.BitbucketAPIException)
+        self.assertEqual(requests_get.call_count, 3)
+
+        with self.assertRaises(bitbucket.BitbucketAPIException):
+            upstream.get('https://example.com', {}, 'bitbucket.watchers', bitbucket.BitbucketAPIException)
+        self.assertEqual(requests_get.call_count, 3)
+
+    @patch('upstream.requests.get')
+    def test_slow_requests_are_hedged(self, requests_get):
+        for _ in range(upstream.HEDGE_MIN_SAMPLES):
+            upstream.LATENCIES['github.repos'].record(0.01)
+
+        release_first = threading.Event()
+        fast = Mock(status_code=200, headers={})
+
+        def get(url, headers, timeout):
+            if requests_get.call_count == 1:
+                release_first.wait(5)
+                return Mock(status_code=200, headers={})
+            return fast
+        requests_get.side_effect = get
+
+        resp = upstream.get('https://example.com', {}, 'github.repos', github.GithubAPIException)
+        release_first.set()
+        self.assertIs(resp, fast)
+        self.assertEqual(requests_get.call_count, 2)
+
+
+    @patch('upstream.RETRY_BACKOFF', 0)
+    @patch('upstream.requests.get')
+    def test_get_waits_for_rate_limit_reset(self, requests_get):
+        used_up = {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(time.time() + 0.05)}
+        requests_get.side_effect = [
+            Mock(status_code=403, headers=used_up),
+            Mock(status_code=200, headers={}),
+        ]
+        started = time.monotonic()
+        resp = upstream.get('https://example.com', {}, 'github.repos', github.GithubAPIException)
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+        self.assertEqual(upstream.BREAKERS['github.repos'].state, 'closed')
+
+        # a limit that resets too far out is given up on without retrying
+        requests_get.reset_mock(side_effect=True)
+        requests_get.return_value = Mock(status_code=429, headers={'Retry-After': '3600'})
+        with patch('upstream.MAX_RATE_LIMIT_WAIT', 0):
+            resp = upstream.get('https://example.com', {}, 'bitbucket.watchers', bitbucket.BitbucketAPIException)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(requests_get.call_count, 1)
+        self.assertEqual(upstream.BREAKERS['bitbucket.watchers'].state, 'closed')
+
+    @patch('upstream.RETRY_BACKOFF', 0)
+    @patch('upstream.requests.get')
+    def test_half_open_trial_is_released(self, requests_get):
+        def half_open(endpoint):
+            breaker = upstream.BREAKERS[endpoint]
+            breaker._opened_at = time.monotonic() - breaker.reset_timeout
+            return breaker
+
+        # a rate limited trial neither closes nor reopens the breaker, but
+        # lets the retry be the next trial
+        breaker = half_open('bitbucket.watchers')
+        requests_get.side_effect = [
+            Mock(status_code=429, headers={'Retry-After': '0'}),
+            Mock(status_code=200, headers={}),
+        ]
+        resp = upstream.get('https://example.com', {}, 'bitbucket.watchers', bitbucket.BitbucketAPIException)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(breaker.state, 'closed')
+
+        # so does a trial that raised something unexpected
+        breaker = half_open('bitbucket.users')
+        requests_get.side_effect = ValueError('bad header')
+        with self.assertRaises(ValueError):
+            upstream.get('https://example.com', {}, 'bitbucket.users', bitbucket.BitbucketAPIException)
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow())
+
+        # and a cancelled async trial
+        breaker = half_open('github.repos')
+
+        async def cancelled_trial():
+            with patch('async_http.get', side_effect=asyncio.CancelledError):
+                await upstream.get_async(None, 'https://example.com', {}, 'github.repos', github.GithubAPIException)
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(cancelled_trial())
+        self.assertTrue(breaker.allow())
+
+    def test_rate_limiter(self):
+        limiter = upstream.RateLimiter(rate=10)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 0.1, delta=0.01)
+
+        unlimited = upstream.RateLimiter()
+        self.assertEqual(unlimited.reserve(), 0)
+        unlimited.pause(5)
+        self.assertAlmostEqual(unlimited.reserve(), 5, delta=0.01)
+
+    @patch('upstream.RETRY_BACKOFF', 0)
+    @patch('async_http.get')
+    def test_get_async_retries(self, get):
+        get.side_effect = [
+            async_http.RequestError('reset'),
+            async_http.AsyncResponse(503, {}, None),
+            async_http.AsyncResponse(200, {}, {'size': 1}),
+        ]
+        resp = asyncio.run(upstream.get_async(
+            None, 'https://example.com', {}, 'bitbucket.watchers', bitbucket.BitbucketAPIException
+        ))
+        self.assertEqual(resp.json(), {'size': 1})
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(upstream.BREAKERS['bitbucket.watchers'].state, 'closed')
+
+    def test_gather_bounded(self):
+        running = []
+        most_running = []
+
+        async def fetch(item):
+            running.append(item)
+            most_running.append(len(running))
+            await asyncio.sleep(0.001)
+            running.remove(item)
+            return item * 2
+
+        results = asyncio.run(async_http.gather_bounded(fetch, list(range(10)), limit=3))
+        self.assertEqual(results, [item * 2 for item in range(10)])
+        self.assertEqual(max(most_running), 3)
+
+
+class FetchProgressTest(unittest.TestCase):
+    def test_partial_profile(self):
+        fetch_progress = progress.FetchProgress()
+        fetch_progress.record(follower_count=5, languages={'go', 'rust'})
+        fetch_progress.record_repo('watcher_count', 2, 3, 10)
+        fetch_progress.record_repo('total_open_issues', 0, 3, 0)
+
+        profile, partial = fetch_progress.partial_profile(db.COUNT_FIELDS)
+        self.assertEqual(profile['follower_count'], 5)
+        self.assertEqual(profile['watcher_count'], 15)
+        self.assertEqual(profile['language_count'], 2)
+        self.assertEqual(partial['watcher_count'], {'status': 'estimated', 'repos_covered': 2, 'repos_total': 3})
+        self.assertEqual(partial['total_open_issues']['repos_covered'], 0)
+        self.assertEqual(partial['repo_topics'], {'status': 'missing'})
+        self.assertNotIn('follower_count', partial)
+
+    def test_finish_and_wait(self):
+        fetch_progress = progress.FetchProgress()
+        self.assertFalse(fetch_progress.wait(0))
+        fetch_progress.finish(result={})
+        self.assertTrue(fetch_progress.wait(0))
+        self.assertEqual(fetch_progress.result, {})
+
+
+@unittest.skipIf(not columnar.available, 'numpy is not installed')
+class ColumnarTest(unittest.TestCase):
+    def test_github_repo_stats_match(self):
+        languages = ['Python', 'python', 'Go', '', None, 'HTML']
+        repos = [
+            {
+                'fork': i % 3 == 0,
+                'language': languages[i % len(languages)],
+                'open_issues_count': i % 7,
+                'size': i * 13,
+                'stargazers_count': i % 11,
+                'topics': [f'topic{i % 5}'] if i % 2 else [],
+                'watchers_count': i % 4,
+            }
+            for i in range(columnar.MIN_REPOS + 17)
+        ]
+        with patch('columnar.available', False):
+            expected = github.get_repo_stats(repos)
+        self.assertEqual(columnar.github_repo_stats(repos), expected)
+        self.assertEqual(github.get_repo_stats(repos), expected)
+        self.assertIs(type(columnar.github_repo_stats(repos)['size']), int)
+
+    def test_bitbucket_repo_stats_match(self):
+        repos = [
+            {'language': ['java', 'Go', ''][i % 3], 'size': i * 3}
+            for i in range(columnar.MIN_REPOS + 5)
+        ]
+        for repo in repos[::4]:
+            repo['parent'] = {'yep': True}
+        with patch('columnar.available', False):
+            expected = bitbucket.get_repo_stats(repos)
+        self.assertEqual(columnar.bitbucket_repo_stats(repos), expected)
+        self.assertEqual(columnar.bitbucket_repo_stats([]), bitbucket.get_repo_stats([]))
+
+    @unittest.skipIf(async_main is None or hypercorn is None, 'quart or hypercorn is not installed')
+    def test_run_async_mode(self):
+        with self.assertRaises(ValueError):
+            loadtest.run(users=5, profiles=10, concurrency=1, duration=0.1, mode='async')
+        report = loadtest.run(
+            users=5, profiles=10, concurrency=2, duration=0.3, mix='get=1,attach=1', transport='http', mode='async'
+        )
+        self.assertEqual(set(report['GET /user/<username>']['statuses']), {200})
+        statuses = {status for route, stats in report.items() if route.startswith('POST') for status in stats['statuses']}
+        self.assertIn(201, statuses)
+
+    def test_run_with_empty_pools(self):
+        report = loadtest.run(users=5, profiles=0, concurrency=2, duration=0.2, mix='attach=1,detach=1', unattached=0)
+        statuses = {status for stats in report.values() for status in stats['statuses']}
+        self.assertIn(201, statuses)
+
+
+class LoadTestTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+
+    def tearDown(self):
+        reset_db()
+
+    def test_parse_mix(self):
+        self.assertEqual(loadtest.parse_mix('get=9,attach=1'), (['get', 'attach'], [9.0, 1.0]))
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('get=9,explode=1')
+
+    def test_run(self):
+        report = loadtest.run(users=5, profiles=10, concurrency=1, duration=0.2, mix='get=1,create=1')
+        self.assertEqual(set(report), {'GET /user/<username>', 'POST /user/<username>'})
+        for stats in report.values():
+            self.assertGreater(stats['requests'], 0)
+            self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+        self.assertEqual(set(report['GET /user/<username>']['statuses']), {200})
+        # 10 attached plus the cached half of the 10 unattached
+        self.assertEqual(len(db.GITHUB_PROFILES), 15)
+
+    def test_run_attach_detach(self):
+        report = loadtest.run(users=5, profiles=10, concurrency=2, duration=0.2, mix='attach=1,detach=1')
+        statuses = {status for stats in report.values() for status in stats['statuses']}
+        self.assertIn(201, statuses)
+        self.assertIn(200, statuses)
+        # every profile is still attached to at most one user
+        attached = [name for user in db.USERS.values() for name in user['github']]
+        self.assertEqual(len(attached), len(set(attached)))
+
+
+class WebhookTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        reset_db()
+
+    @patch('db.get_github_profile')
+    def attach_github(self, get_github_profile, **counts):
+        get_github_profile.return_value = make_profile(**counts)
+        db.user.create('david')
+        db.github.add('david', 'coolranchdoritos')
+
+    @patch('db.get_bitbucket_profile')
+    def attach_bitbucket(self, get_bitbucket_profile, **counts):
+        get_bitbucket_profile.return_value = make_profile(**counts)
+        db.user.create('david')
+        db.bitbucket.add('david', 'pygame')
+
+    def github_repo(self, **fields):
+        repo = {
+            'owner': {'login': 'coolranchdoritos'}, 'fork': False, 'default_branch': 'main',
+            'open_issues_count': 2, 'stargazers_count': 3, 'watchers_count': 3, 'size': 10,
+            'language': 'Rust', 'topics': ['cli'],
+        }
+        repo.update(fields)
+        return repo
+
+    def test_github_push(self):
+        self.attach_github(total_source_commit_count=5)
+        payload = {'ref': 'refs/heads/main', 'repository': self.github_repo(), 'commits': [{}, {}]}
+        _, status_code = webhooks.handle_github('push', payload)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 7)
+        self.assertEqual(db.leaderboard.get('total_source_commit_count')[0]['leaders'][0]['value'], 7)
+
+        # pushes to other branches and to forks don't count
+        payload['ref'] = 'refs/heads/feature'
+        self.assertEqual(webhooks.handle_github('push', payload)[1], 202)
+        payload.update(ref='refs/heads/main', repository=self.github_repo(fork=True))
+        self.assertEqual(webhooks.handle_github('push', payload)[1], 202)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 7)
+
+        # an adjusted profile keeps the fetch time of its last crawl
+        self.assertTrue(db.is_fresh('github', 'coolranchdoritos', 60))
+        # a forced push may have dropped commits, so it is left to a re-crawl
+        payload.update(repository=self.github_repo(), forced=True)
+        self.assertEqual(webhooks.handle_github('push', payload)[1], 202)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 7)
+        self.assertFalse(db.is_fresh('github', 'coolranchdoritos', 60))
+
+    def test_github_star_and_repositories(self):
+        self.attach_github(stars_received=1, watcher_count=1)
+        repo = self.github_repo()
+        webhooks.handle_github('star', {'action': 'created', 'repository': repo})
+        self.assertEqual(db.user.get('david')[0]['stars_received'], 2)
+
+        webhooks.handle_github('repository', {'action': 'created', 'repository': repo})
+        profile, _ = db.user.get('david')
+        self.assertEqual(profile['public_source_repositories'], 1)
+        self.assertEqual(profile['stars_received'], 5)
+        self.assertEqual(profile['languages'], ['rust'])
+        self.assertEqual(db.search.get(languages=['rust'])[0]['users'], ['david'])
+
+        self.assertTrue(db.is_fresh('github', 'coolranchdoritos', 60))
+        webhooks.handle_github('repository', {'action': 'deleted', 'repository': repo})
+        profile, _ = db.user.get('david')
+        self.assertEqual(profile['public_source_repositories'], 0)
+        self.assertEqual(profile['stars_received'], 2)
+        # the deleted repo's commits are only dropped by a re-crawl
+        self.assertFalse(db.is_fresh('github', 'coolranchdoritos', 60))
+
+        forkee = self.github_repo(stargazers_count=0, watchers_count=0)
+        webhooks.handle_github('fork', {'forkee': forkee, 'repository': self.github_repo()})
+        self.assertEqual(db.user.get('david')[0]['public_fork_repositories'], 1)
+
+    def test_github_ignored_and_malformed(self):
+        self.attach_github()
+        payload = {'action': 'created', 'repository': self.github_repo(owner={'login': 'someone_else'})}
+        self.assertEqual(webhooks.handle_github('star', payload)[1], 202)
+        self.assertNotIn('someone_else', db.GITHUB_PROFILES)
+        self.assertEqual(webhooks.handle_github('issues', payload)[1], 202)
+        self.assertEqual(webhooks.handle_github('push', {'repository': {}})[1], 400)
+
+    def test_private_repos_are_ignored(self):
+        self.attach_github(stars_received=1)
+        repo = self.github_repo(private=True)
+        payload = {'ref': 'refs/heads/main', 'repository': repo, 'commits': [{}]}
+        self.assertEqual(webhooks.handle_github('push', payload)[1], 202)
+        self.assertEqual(webhooks.handle_github('star', {'action': 'created', 'repository': repo})[1], 202)
+        self.assertEqual(webhooks.handle_github('repository', {'action': 'created', 'repository': repo})[1], 202)
+        payload = {'forkee': repo, 'repository': self.github_repo()}
+        self.assertEqual(webhooks.handle_github('fork', payload)[1], 202)
+        self.assertEqual(db.GITHUB_PROFILES['coolranchdoritos'], make_profile(stars_received=1))
+
+        db.user.delete('david')
+        self.attach_bitbucket(total_source_commit_count=5)
+        repo = {'full_name': 'pygame/secret', 'is_private': True, 'size': 10}
+        payload = {'repository': repo, 'push': {'changes': [{'commits': [{}]}]}}
+        self.assertEqual(webhooks.handle_bitbucket('repo:push', payload)[1], 202)
+        self.assertEqual(webhooks.handle_bitbucket('repo:created', {'repository': repo})[1], 202)
+        self.assertEqual(webhooks.handle_bitbucket('repo:fork', {'repository': repo, 'fork': repo})[1], 202)
+        self.assertEqual(db.BITBUCKET_PROFILES['pygame'], make_profile(total_source_commit_count=5))
+
+    def test_bitbucket_push(self):
+        self.attach_bitbucket(total_source_commit_count=5)
+        payload = {
+            'repository': {'full_name': 'pygame/pygame'},
+            'push': {'changes': [{'commits': [{}, {}]}, {'commits': [{}]}]},
+        }
+        self.assertEqual(webhooks.handle_bitbucket('repo:push', payload)[1], 200)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 8)
+
+        # with a cursor the new commits are recounted in the background
+        # instead of trusting the payload
+        bitbucket.COMMIT_CURSORS[('pygame', 'pygame')] = {'hash': 'abc', 'count': 40}
+        with patch('bitbucket.get_repo_commit_count', return_value=50) as get_repo_commit_count:
+            self.assertEqual(webhooks.handle_bitbucket('repo:push', payload)[1], 202)
+            webhooks.wait_for_recounts()
+        get_repo_commit_count.assert_called_once_with('pygame', 'pygame')
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 18)
+        self.assertTrue(db.is_fresh('bitbucket', 'pygame', 60))
+
+        # a failed recount leaves the profile to be re-crawled
+        error = bitbucket.BitbucketAPIException('boom')
+        with patch('bitbucket.get_repo_commit_count', side_effect=error), self.assertLogs('webhooks'):
+            webhooks.handle_bitbucket('repo:push', payload)
+            webhooks.wait_for_recounts()
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 18)
+        self.assertFalse(db.is_fresh('bitbucket', 'pygame', 60))
+
+        webhooks.handle_bitbucket('repo:fork', {'fork': {'full_name': 'pygame/fork', 'size': 4}})
+        profile, _ = db.user.get('david')
+        self.assertEqual(profile['public_fork_repositories'], 1)
+        self.assertEqual(profile['total_account_size'], 4)
+
+    def test_bitbucket_forced_push_and_delete(self):
+        self.attach_bitbucket(total_source_commit_count=50, public_source_repositories=2)
+        payload = {
+            'repository': {'full_name': 'pygame/pygame'},
+            'push': {'changes': [{'forced': True, 'commits': [{}]}]},
+        }
+        self.assertEqual(webhooks.handle_bitbucket('repo:push', payload)[1], 202)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 50)
+        self.assertFalse(db.is_fresh('bitbucket', 'pygame', 60))
+
+        # a truncated push counts the commits it lists, but needs a re-crawl
+        db.FETCHED_AT['bitbucket']['pygame'] = time.time()
+        payload['push']['changes'] = [{'truncated': True, 'commits': [{}, {}]}]
+        self.assertEqual(webhooks.handle_bitbucket('repo:push', payload)[1], 200)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 52)
+        self.assertFalse(db.is_fresh('bitbucket', 'pygame', 60))
+
+        # deleting a repo takes its commits out of the count with its cursor,
+        # and leaves its watchers and open issues to a re-crawl
+        db.FETCHED_AT['bitbucket']['pygame'] = time.time()
+        bitbucket.COMMIT_CURSORS[('pygame', 'pygame')] = {'hash': 'abc', 'count': 40}
+        _, status_code = webhooks.handle_bitbucket('repo:deleted', {'repository': {'full_name': 'pygame/pygame'}})
+        self.assertEqual(status_code, 200)
+        profile, _ = db.user.get('david')
+        self.assertEqual(profile['total_source_commit_count'], 12)
+        self.assertEqual(profile['public_source_repositories'], 1)
+        self.assertNotIn(('pygame', 'pygame'), bitbucket.COMMIT_CURSORS)
+        self.assertFalse(db.is_fresh('bitbucket', 'pygame', 60))
+
+    def test_partial_profile_stays_partial(self):
+        self.attach_bitbucket(total_source_commit_count=5)
+        db.PARTIAL_PROFILES[('bitbucket', 'pygame')] = {'fields': {'total_source_commit_count': {'status': 'missing'}}}
+        payload = {'repository': {'full_name': 'pygame/pygame'}, 'push': {'changes': [{'commits': [{}]}]}}
+        webhooks.handle_bitbucket('repo:push', payload)
+        self.assertEqual(db.user.get('david')[0]['total_source_commit_count'], 6)
+        self.assertIn(('bitbucket', 'pygame'), db.PARTIAL_PROFILES)
+
+    def test_verify_signature(self):
+        body = b'{"zen": "hi"}'
+        _, headers, _ = replay_webhooks.build_request('github', 'ping', {'zen': 'hi'}, secret='s3cret')
+        signature = headers['X-Hub-Signature-256']
+        self.assertTrue(webhooks.verify_signature('s3cret', body, signature))
+        self.assertFalse(webhooks.verify_signature('wrong', body, signature))
+        self.assertFalse(webhooks.verify_signature('s3cret', body, None))
+
+    def test_route(self):
+        self.attach_github(stars_received=1)
+
+        def post(path, headers, body):
+            response = self.client.post(path, headers=headers, data=body)
+            return response.status_code, response.get_json()['msg']
+
+        deliveries = replay_webhooks.read_recording([
+            '# recorded deliveries',
+            json.dumps({'provider': 'github', 'event': 'star',
+                        'payload': {'action': 'created', 'repository': self.github_repo()}}),
+            '',
+        ])
+        with patch.dict(main.WEBHOOK_SECRETS, {'github': 's3cret'}):
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(replay_webhooks.replay(list(deliveries), post, {'github': 's3cret'}), [200])
+            response = self.client.get('/user/david')
+            self.assertEqual(response.get_json()['stars_received'], 2)
+
+            response = self.client.post('/webhooks/github', headers={'X-GitHub-Event': 'star'}, data=b'{}')
+            self.assertEqual(response.status_code, 401)
+
+        # without a secret deliveries are rejected unless unsigned ones are allowed
+        headers = {'X-Event-Key': 'repo:push'}
+        self.assertEqual(self.client.post('/webhooks/bitbucket', headers=headers, data=b'{}').status_code, 403)
+        with patch('main.ALLOW_UNSIGNED_WEBHOOKS', True):
+            response = self.client.post('/webhooks/bitbucket', headers=headers, data=b'not json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/webhooks/gitlab').status_code, 404)
+
+
+class SortedIndexTest(unittest.TestCase):
+    def test_ordering_and_rank(self):
+        index = indexes.SortedIndex()
+        index.set('a', 3)
+        index.set('b', 10)
+        index.set('c', 3)
+        self.assertEqual(index.top(10), [('b', 10), ('a', 3), ('c', 3)])
+        self.assertEqual(index.rank('c'), 3)
+
+        index.increment('c', 20)
+        self.assertEqual(index.top(1), [('c', 23)])
+        self.assertEqual(index.rank('b'), 2)
+
+        index.remove('b')
+        self.assertEqual(len(index), 2)
+        self.assertNotIn('b', index)
+        self.assertEqual(index.top(10), [('c', 23), ('a', 3)])
+
+
+class InvertedIndexTest(unittest.TestCase):
+    def test_refcounted_postings(self):
+        index = indexes.InvertedIndex()
+        index.add('david', {'python', 'go'})
+        index.add('david', {'python'})
+        index.add('chester', {'python'})
+
+        self.assertEqual(index.match_all(['python', 'go']), {'david'})
+        self.assertEqual(index.match_any(['go', 'python']), {'david', 'chester'})
+
+        index.remove('david', {'python', 'go'})
+        self.assertEqual(index.match_all(['python']), {'david', 'chester'})
+        self.assertEqual(index.match_any(['go']), set())
+
+        index.remove('david', {'python'})
+        self.assertEqual(index.match_all(['python']), {'chester'})
+        self.assertEqual(index.match_all([]), set())
+
 
 if __name__ == '__main__':
     unittest.main()
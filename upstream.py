@@ -0,0 +1,312 @@
+'''Resilient GETs against the upstream github/bitbucket APIs.
+
+Every call is made through get, which layers three things over requests.get:
+
+* a circuit breaker per endpoint, so an endpoint that keeps failing is
+  failed fast for a while instead of waiting on every socket,
+* retries with exponential backoff for connection errors, timeouts and
+  retryable status codes (all of the calls are idempotent GETs),
+* hedging: once an endpoint has enough latency samples, a call that runs
+  past the HEDGE_PERCENTILE latency gets a duplicate request and whichever
+  finishes first wins,
+* rate limiting per provider: every request waits on RATE_LIMITERS[provider],
+  which is unlimited unless given a rate (see prefetch.py) but is paused
+  whenever a response says the upstream rate limit is used up. Rate limited
+  403/429 responses are retried once the limit resets, if that is within
+  MAX_RATE_LIMIT_WAIT seconds.
+
+get_async does the same for the aiohttp based fetchers used in async mode,
+sharing the breakers and latencies, but without hedging.
+'''
+import asyncio
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+import async_http
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 30)
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# github answers 403 when the rate limit is used up, bitbucket 429
+RATE_LIMIT_STATUS_CODES = {403, 429}
+MAX_RATE_LIMIT_WAIT = 60
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+# hedged requests run here so the calling thread can wait on whichever
+# request finishes first
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='upstream')
+
+
+class CircuitBreaker:
+    '''Opens after FAILURE_THRESHOLD consecutive failures.
+
+    While open calls are rejected until RESET_TIMEOUT seconds have passed,
+    then a single trial call is let through: success closes the breaker and
+    failure opens it again.
+    '''
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = failure_threshold or FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or RESET_TIMEOUT
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        '''Return True if a call may be made right now.'''
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self):
+        '''End a call that says nothing about the endpoint's health, e.g. a rate limited one.
+
+        The failure count is left alone, but if the call was the half-open
+        trial another one may be made.
+        '''
+        with self._lock:
+            self._trial_running = False
+
+
+class LatencyTracker:
+    '''Keeps the most recent latencies of an endpoint.'''
+
+    def __init__(self, window=None):
+        self._samples = deque(maxlen=window or LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction, min_samples=None):
+        '''Return the latency at fraction, or None with fewer than min_samples samples.'''
+        with self._lock:
+            if len(self._samples) < (min_samples or HEDGE_MIN_SAMPLES):
+                return None
+            samples = sorted(self._samples)
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class RateLimiter:
+    '''Spaces out requests so at most rate of them start per second.
+
+    Without a rate requests aren't spaced out, but pause still holds every
+    request back for a while, e.g. until an upstream rate limit resets.
+    '''
+
+    def __init__(self, rate=None):
+        self._interval = 1 / rate if rate else 0
+        self._next_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        '''Reserve the next start time and return how many seconds to wait for it.'''
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        return start - now
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    def pause(self, seconds):
+        '''Hold back requests that haven't started yet for seconds.'''
+        with self._lock:
+            self._next_start = max(self._next_start, time.monotonic() + seconds)
+
+
+BREAKERS = defaultdict(CircuitBreaker)
+LATENCIES = defaultdict(LatencyTracker)
+# keyed by provider, the part of the endpoint before the dot
+RATE_LIMITERS = defaultdict(RateLimiter)
+
+
+def _rate_limit_wait(resp):
+    '''Return how many seconds resp asks to wait before the next request, or None.'''
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            # the HTTP date form isn't used by github or bitbucket
+            return None
+    reset = resp.headers.get('X-RateLimit-Reset')
+    if resp.headers.get('X-RateLimit-Remaining') == '0' and reset is not None:
+        return max(0.0, float(reset) - time.time())
+    return None
+
+
+def _check_rate_limit(resp, limiter):
+    '''Pause limiter if resp used up the rate limit.
+
+    Returns 'retry' for a rate limited response worth retrying, 'give up'
+    for one whose limit resets too far out, and None otherwise.
+    '''
+    seconds = _rate_limit_wait(resp)
+    if seconds is None:
+        return None
+    limiter.pause(min(seconds, MAX_RATE_LIMIT_WAIT))
+    if resp.status_code not in RATE_LIMIT_STATUS_CODES:
+        return None
+    return 'retry' if seconds <= MAX_RATE_LIMIT_WAIT else 'give up'
+
+
+def _timed_get(url, headers, limiter):
+    limiter.acquire()
+    started = time.monotonic()
+    resp = requests.get(url, headers=headers, timeout=TIMEOUT)
+    return resp, time.monotonic() - started
+
+
+def _hedged_get(url, headers, endpoint, limiter):
+    '''GET url, sending a duplicate request if the first is slower than usual.'''
+    hedge_after = LATENCIES[endpoint].percentile(HEDGE_PERCENTILE)
+    if hedge_after is None:
+        resp, seconds = _timed_get(url, headers, limiter)
+    else:
+        futures = [_executor.submit(_timed_get, url, headers, limiter)]
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            futures.append(_executor.submit(_timed_get, url, headers, limiter))
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+        # prefer a request that succeeded if the first one to finish raised
+        finished = next((future for future in done if future.exception() is None), None)
+        if finished is None:
+            pending = [future for future in futures if future not in done]
+            finished = pending[0] if pending else done.pop()
+        resp, seconds = finished.result()
+
+    LATENCIES[endpoint].record(seconds)
+    return resp
+
+
+def get(url, headers, endpoint, exception_class):
+    '''GET url through the circuit breaker, retries and hedging for endpoint.
+
+    Raises exception_class if the breaker is open or every attempt failed to
+    get a response at all. A response with an error status is returned after
+    the last retry so the caller can report it as before.
+    '''
+    breaker = BREAKERS[endpoint]
+    limiter = RATE_LIMITERS[endpoint.split('.')[0]]
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        if not breaker.allow():
+            raise exception_class(f'{endpoint} is failing, not calling it until it recovers.')
+
+        try:
+            resp = _hedged_get(url, headers, endpoint, limiter)
+        except requests.RequestException as e:
+            breaker.record_failure()
+            error = e
+            resp = None
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+
+        # a used up rate limit says nothing about the endpoint's health
+        rate_limited = _check_rate_limit(resp, limiter)
+        if rate_limited:
+            breaker.release()
+        if rate_limited == 'retry':
+            continue
+        if rate_limited == 'give up':
+            return resp
+
+        if resp.status_code in RETRY_STATUS_CODES:
+            breaker.record_failure()
+            continue
+        breaker.record_success()
+        return resp
+
+    if resp is not None:
+        return resp
+    raise exception_class(f'Error calling {endpoint}: {error}')
+
+
+async def get_async(session, url, headers, endpoint, exception_class):
+    '''Async version of get, making the request with async_http on session.'''
+    breaker = BREAKERS[endpoint]
+    limiter = RATE_LIMITERS[endpoint.split('.')[0]]
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        if not breaker.allow():
+            raise exception_class(f'{endpoint} is failing, not calling it until it recovers.')
+
+        try:
+            await asyncio.sleep(limiter.reserve())
+            started = time.monotonic()
+            resp = await async_http.get(session, url, headers, timeout=TIMEOUT)
+        except async_http.RequestError as e:
+            breaker.record_failure()
+            error = e
+            resp = None
+            continue
+        except BaseException:
+            # e.g. the crawl was cancelled
+            breaker.release()
+            raise
+        LATENCIES[endpoint].record(time.monotonic() - started)
+
+        rate_limited = _check_rate_limit(resp, limiter)
+        if rate_limited:
+            breaker.release()
+        if rate_limited == 'retry':
+            continue
+        if rate_limited == 'give up':
+            return resp
+
+        if resp.status_code in RETRY_STATUS_CODES:
+            breaker.record_failure()
+            continue
+        breaker.record_success()
+        return resp
+
+    if resp is not None:
+        return resp
+    raise exception_class(f'Error calling {endpoint}: {error}')
@@ -0,0 +1,263 @@
+'''Apply github/bitbucket webhook events to cached profiles.
+
+Instead of re-crawling a profile, an event adjusts the cached copy: a push
+adds its commits to total_source_commit_count, a star moves stars_received,
+and created/deleted/forked repos add or remove that repo's stats. The
+adjusted profile goes through db.update_profile, so the leaderboards, search
+indexes and user versions of whoever it is attached to follow along.
+
+Events for profiles that aren't cached are ignored, they'll be crawled in
+full when first attached. Languages and topics are only ever added: a
+deleted repo's language may still be used by another repo, and only a full
+refresh can tell. Likewise a deleted github repo's commits stay in
+total_source_commit_count, since the payload doesn't say how many there
+were; the profile is marked stale instead so prefetch re-crawls it. The same
+goes for a deleted bitbucket repo's watchers and open issues, for forced
+pushes, which may have removed commits, and for truncated bitbucket pushes
+to repos without a commit cursor, which only list their first commits. Events for private
+repos are ignored, since crawls only see public ones.
+
+An adjusted profile keeps its fetch time and partial entry, it hasn't been
+crawled. Bitbucket pushes to repos with a commit cursor are recounted on a
+background thread, so a request never waits on upstream.
+'''
+import hashlib
+import hmac
+import logging
+import queue
+import threading
+
+import bitbucket
+import db
+
+logger = logging.getLogger(__name__)
+
+# bitbucket (owner, repo slug) pairs waiting for their commits to be recounted
+_RECOUNTS = queue.Queue()
+_recount_thread = None
+_recount_thread_lock = threading.Lock()
+
+
+def verify_signature(secret, body, signature):
+    '''Check a `sha256=<hex digest>` signature header against the HMAC of body.'''
+    if not signature or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature[len('sha256='):])
+
+
+def _copy_profile(profile):
+    copied = dict(profile)
+    copied['languages'] = set(profile['languages'])
+    copied['repo_topics'] = set(profile['repo_topics'])
+    return copied
+
+
+def _apply(provider, name, event, adjust):
+    '''Run adjust on a copy of a cached profile and store the result.'''
+    profiles = db.BITBUCKET_PROFILES if provider == 'bitbucket' else db.GITHUB_PROFILES
+    # held across the read and the write so concurrent events don't lose updates
+    with db.STORE_LOCK:
+        if name not in profiles:
+            return {'msg': f'{provider} profile {name} is not cached, ignoring {event}'}, 202
+
+        profile = _copy_profile(profiles[name])
+        adjust(profile)
+        profile['language_count'] = len(profile['languages'])
+        profile['repo_topics_count'] = len(profile['repo_topics'])
+        db.update_profile(provider, name, profile, fetched=False)
+    return {'msg': f'applied {event} to {provider} profile {name}'}, 200
+
+
+def _is_private(payload, repo_keys, flag):
+    '''Return True if any of the repos in payload under repo_keys has flag set.'''
+    return any(isinstance(payload.get(key), dict) and payload[key].get(flag) for key in repo_keys)
+
+
+def _github_repo_adjuster(repo, sign):
+    '''Return a function that adds (sign=1) or removes (sign=-1) a github repo's stats.'''
+    def adjust(profile):
+        if repo['fork']:
+            profile['public_fork_repositories'] += sign
+        else:
+            profile['public_source_repositories'] += sign
+        profile['total_open_issues'] += sign * repo.get('open_issues_count', 0)
+        profile['stars_received'] += sign * repo.get('stargazers_count', 0)
+        profile['watcher_count'] += sign * repo.get('watchers_count', 0)
+        profile['total_account_size'] += sign * repo.get('size', 0)
+        if sign > 0:
+            if repo.get('language'):
+                profile['languages'].add(repo['language'].lower())
+            profile['repo_topics'].update(repo.get('topics', []))
+    return adjust
+
+
+def handle_github(event, payload):
+    '''Apply a github webhook event, named by its X-GitHub-Event header.'''
+    if _is_private(payload, ('repository', 'forkee'), 'private'):
+        return {'msg': f'ignoring github {event} for a private repo'}, 202
+    try:
+        if event == 'push':
+            repo = payload['repository']
+            # commits are counted on the default branch of source repos only
+            if repo['fork'] or payload['ref'] != f'refs/heads/{repo["default_branch"]}':
+                return {'msg': f'ignoring push to {payload["ref"]}'}, 202
+            if payload.get('forced'):
+                db.mark_stale('github', repo['owner']['login'])
+                return {'msg': f'ignoring forced push to {payload["ref"]}, marked the profile stale'}, 202
+            new_commits = len(payload['commits'])
+
+            def adjust(profile):
+                profile['total_source_commit_count'] += new_commits
+            return _apply('github', repo['owner']['login'], event, adjust)
+
+        if event == 'star':
+            repo = payload['repository']
+            sign = 1 if payload['action'] == 'created' else -1
+
+            # github reports watchers_count as the star count
+            def adjust(profile):
+                profile['stars_received'] += sign
+                profile['watcher_count'] += sign
+            return _apply('github', repo['owner']['login'], event, adjust)
+
+        if event == 'repository' and payload['action'] in ('created', 'deleted'):
+            repo = payload['repository']
+            sign = 1 if payload['action'] == 'created' else -1
+            response = _apply('github', repo['owner']['login'], event, _github_repo_adjuster(repo, sign))
+            if sign < 0:
+                # its commits are still counted, see the module docstring
+                db.mark_stale('github', repo['owner']['login'])
+            return response
+
+        if event == 'fork':
+            # the new fork belongs to whoever forked the repo
+            forkee = dict(payload['forkee'], fork=True)
+            return _apply('github', forkee['owner']['login'], event, _github_repo_adjuster(forkee, 1))
+    except (KeyError, TypeError):
+        return {'msg': f'malformed github {event} payload'}, 400
+
+    return {'msg': f'unsupported github event {event}'}, 202
+
+
+def _bitbucket_owner(repo):
+    # full_name is <workspace>/<repo slug>, and the workspace is the profile name
+    return repo['full_name'].split('/')[0]
+
+
+def _bitbucket_slug(repo):
+    return repo['full_name'].split('/')[1]
+
+
+def _queue_recount(owner, slug):
+    '''Queue a commit recount of a bitbucket repo, starting the recount thread if needed.'''
+    global _recount_thread
+    with _recount_thread_lock:
+        if _recount_thread is None:
+            _recount_thread = threading.Thread(target=_run_recounts, name='webhook-recounts', daemon=True)
+            _recount_thread.start()
+    _RECOUNTS.put((owner, slug))
+
+
+def _run_recounts():
+    while True:
+        owner, slug = _RECOUNTS.get()
+        try:
+            _recount_commits(owner, slug)
+        except Exception:
+            # the pushed commits are missing from the profile until it is crawled again
+            logger.exception('recounting commits of bitbucket repo %s/%s failed', owner, slug)
+            db.mark_stale('bitbucket', owner)
+        finally:
+            _RECOUNTS.task_done()
+
+
+def _recount_commits(owner, slug):
+    '''Recount a repo from its commit cursor and add the new commits to the cached profile.
+
+    Bitbucket only includes the first few commits of a change, so this only
+    pages through the new commits and moves the cursor along. If history was
+    rewritten the walk runs to the end, so forced pushes are counted right too.
+    '''
+    cursor = bitbucket.COMMIT_CURSORS.get((owner, slug))
+    if cursor is None:
+        # the repo was deleted after the push was queued
+        return
+    new_commits = bitbucket.get_repo_commit_count(owner, slug) - cursor['count']
+
+    def adjust(profile):
+        profile['total_source_commit_count'] += new_commits
+    _apply('bitbucket', owner, 'repo:push', adjust)
+
+
+def wait_for_recounts():
+    '''Block until every queued commit recount has been applied.'''
+    _RECOUNTS.join()
+
+
+def _bitbucket_repo_adjuster(repo, sign, fork=False, commits=0):
+    '''Return a function that adds (sign=1) or removes (sign=-1) a bitbucket repo's stats.'''
+    def adjust(profile):
+        if fork or 'parent' in repo:
+            profile['public_fork_repositories'] += sign
+        else:
+            profile['public_source_repositories'] += sign
+        profile['total_account_size'] += sign * repo.get('size', 0)
+        profile['total_source_commit_count'] += sign * commits
+        if sign > 0 and repo.get('language'):
+            profile['languages'].add(repo['language'].lower())
+    return adjust
+
+
+def handle_bitbucket(event, payload):
+    '''Apply a bitbucket webhook event, named by its X-Event-Key header.'''
+    if _is_private(payload, ('repository', 'fork'), 'is_private'):
+        return {'msg': f'ignoring bitbucket {event} for a private repo'}, 202
+    try:
+        if event == 'repo:push':
+            repo = payload['repository']
+            owner = _bitbucket_owner(repo)
+            if owner not in db.BITBUCKET_PROFILES:
+                return {'msg': f'bitbucket profile {owner} is not cached, ignoring {event}'}, 202
+            slug = _bitbucket_slug(repo)
+            if (owner, slug) in bitbucket.COMMIT_CURSORS:
+                _queue_recount(owner, slug)
+                return {'msg': f'queued a commit recount of {owner}/{slug}'}, 202
+
+            # without a cursor the commits in the payload are the best available count
+            changes = payload['push']['changes']
+            if any(change.get('forced') for change in changes):
+                db.mark_stale('bitbucket', owner)
+                return {'msg': f'ignoring forced push to {owner}/{slug}, marked the profile stale'}, 202
+            new_commits = sum(len(change.get('commits', [])) for change in changes)
+
+            def adjust(profile):
+                profile['total_source_commit_count'] += new_commits
+            response = _apply('bitbucket', owner, event, adjust)
+            if any(change.get('truncated') for change in changes):
+                # only the first commits of a large push are listed
+                db.mark_stale('bitbucket', owner)
+            return response
+
+        if event == 'repo:created':
+            repo = payload['repository']
+            return _apply('bitbucket', _bitbucket_owner(repo), event, _bitbucket_repo_adjuster(repo, 1))
+
+        if event == 'repo:deleted':
+            repo = payload['repository']
+            owner = _bitbucket_owner(repo)
+            # the cursor holds the commits the repo added to total_source_commit_count
+            cursor = bitbucket.COMMIT_CURSORS.pop((owner, _bitbucket_slug(repo)), None)
+            commits = cursor['count'] if cursor else 0
+            response = _apply('bitbucket', owner, event, _bitbucket_repo_adjuster(repo, -1, commits=commits))
+            # the payload doesn't have the repo's watchers or open issues
+            db.mark_stale('bitbucket', owner)
+            return response
+
+        if event == 'repo:fork':
+            fork = payload['fork']
+            return _apply('bitbucket', _bitbucket_owner(fork), event, _bitbucket_repo_adjuster(fork, 1, fork=True))
+    except (KeyError, TypeError, IndexError):
+        return {'msg': f'malformed bitbucket {event} payload'}, 400
+
+    return {'msg': f'unsupported bitbucket event {event}'}, 202